@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+from diffengine import DIFF_ENGINES
+from reviewer import CallType
+from reviewer import CommitRef
+from reviewer import LineType
+from reviewer import Reviewer
+
+import argparse
+import logging
+import re
+import sys
+import timeit
+
+logger = logging.getLogger('rom')
+logger.setLevel(logging.DEBUG) # leave this to handlers
+
+def setup_logging(args):
+  info_handler = logging.StreamHandler(sys.stdout)
+  info_handler.setFormatter(logging.Formatter('%(levelname)6s - %(name)s - %(message)s'))
+  if args.verbose:
+    info_handler.setLevel(logging.DEBUG)
+  else:
+    info_handler.setLevel(logging.INFO)
+  logger.addHandler(info_handler)
+
+
+def reference_classify_line(line):
+  # The original classifier, kept around to check results and timing against
+  for t in LineType:
+    m = re.match(t.value, line)
+    if m:
+      return (t,m)
+  return None
+
+
+def load_patches(args, reviewer):
+  patches = []
+  for p in args.patch or []:
+    with open(p, 'rt', errors='replace') as f:
+      patches.append(f.read())
+
+  if args.commits:
+    cmd = ['log', '--no-merges', '--format=%H', '-n', str(args.max_commits),
+           args.commits]
+    shas = reviewer.git(cmd, CallType.CHECK_OUTPUT).split()
+    for s in shas:
+      patches.append(reviewer.get_commit_from_sha(CommitRef(sha=s)))
+
+  return patches
+
+
+def time_it(name, func, repeat):
+  t = min(timeit.repeat(func, number=1, repeat=repeat))
+  logger.info('  {:<12} {:10.2f}ms'.format(name, t * 1000))
+  return t
+
+
+def bench_classify(args, reviewer, patches):
+  lines = []
+  for p in patches:
+    lines += p.split('\n')
+  logger.info('Classifying {} lines from {} patches'.format(len(lines),
+                                                           len(patches)))
+
+  for l in lines:
+    a = reference_classify_line(l)
+    b = reviewer.classify_line(l)
+    if (a[0] != b[0] or a[1].span() != b[1].span() or
+        a[1].groups() != b[1].groups()):
+      logger.error('Mismatch classifying "{}": {} != {}'.format(l, a, b))
+      return 1
+
+  ref = time_it('reference', lambda: [reference_classify_line(l) for l in lines],
+                args.repeat)
+  new = time_it('classifier', lambda: [reviewer.classify_line(l) for l in lines],
+                args.repeat)
+  logger.info('  speedup      {:10.2f}x'.format(ref / new if new else 0))
+  return 0
+
+
+def bench_diff(args, reviewer, patches):
+  if len(patches) < 2:
+    logger.error('Need at least 2 patches to compare')
+    return 1
+
+  # Consecutive patches are compared against each other
+  pairs = list(zip(patches[::2], patches[1::2]))
+  logger.info('Comparing {} pairs of patches'.format(len(pairs)))
+
+  for name in DIFF_ENGINES.keys():
+    r = Reviewer(args.verbose, git_dir=args.git_dir, diff_engine=name)
+    num_lines = sum([len(r.compare_diffs(a, b)) for a, b in pairs])
+    time_it(name, lambda: [r.compare_diffs(a, b) for a, b in pairs],
+            args.repeat)
+    logger.info('  {:<12} {:10} lines of diff'.format('', num_lines))
+  return 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark review-o-matic')
+  parser.add_argument('--git-dir', default=None, help='Path to git directory')
+  parser.add_argument('--verbose', help='print commits', action='store_true')
+  parser.add_argument('--patch', action='append',
+                      help='Path to a recorded patch (may be repeated)')
+  parser.add_argument('--commits', default=None,
+                      help='Revision range in git-dir to record patches from')
+  parser.add_argument('--max-commits', default=100, type=int,
+                      help='Maximum number of commits to record')
+  parser.add_argument('--repeat', default=5, type=int,
+                      help='Number of timed runs, the fastest is reported')
+  parser.add_argument('bench', choices=['classify', 'diff'], help='What to benchmark')
+  args = parser.parse_args()
+
+  setup_logging(args)
+
+  reviewer = Reviewer(args.verbose, git_dir=args.git_dir)
+  patches = load_patches(args, reviewer)
+  if not patches:
+    logger.error('No patches given, use --patch and/or --commits')
+    return 1
+
+  if args.bench == 'classify':
+    return bench_classify(args, reviewer, patches)
+  elif args.bench == 'diff':
+    return bench_diff(args, reviewer, patches)
+
+if __name__ == '__main__':
+  sys.exit(main())
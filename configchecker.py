@@ -1,4 +1,11 @@
+from kconfigmerge import KconfigFragmentMerger
+from kconfigmerge import format_config
+from kconfigmerge import parse_config
+
+import collections
+import concurrent.futures
 import errno
+import json
 import logging
 from pathlib import Path
 import shutil
@@ -7,39 +14,139 @@ import subprocess
 logger = logging.getLogger('rom.configchecker')
 
 class KernelConfigChecker():
-  def __init__(self, verbose=False, reviewer=None):
+  # How configs are generated:
+  #   script: run `kernelconfig genconfig` on checkouts of the commits
+  #   native: merge the config fragments in-process (see KconfigFragmentMerger)
+  #   verify: like script, but also merge natively and log any disagreements
+  GENERATORS = ('script', 'native', 'verify')
+
+  def __init__(self, verbose=False, reviewer=None, worktrees=None,
+               config_cache=None, generator='script'):
+    if generator not in self.GENERATORS:
+      raise ValueError('Invalid config generator {}'.format(generator))
     self.reviewer = reviewer
     self.verbose = verbose
-    self.kernel_dir = Path()
-    if self.reviewer.git_dir:
-      self.kernel_dir = Path(self.reviewer.git_dir)
+    self.generator = generator
+    self.merger = KconfigFragmentMerger(reviewer)
+    # If given, a PatchCache of generated configs (see get_baseline_key)
+    self.config_cache = config_cache
+    # If given, a WorktreePool of the kernel repo to generate configs in,
+    # rather than the local repo's own checkout
+    self.worktrees = worktrees
+    self.kernel_dir = self.get_kernel_dir(self.reviewer)
     if not self.kernel_dir.is_dir():
       raise ValueError('{} is not a directory!'.format(self.kernel_dir))
 
-    self.config_cmd = self.kernel_dir.joinpath('chromeos/scripts/kernelconfig')
-    self.genconfig_dir = self.kernel_dir.joinpath('CONFIGS')
-    if not self.genconfig_dir.is_dir():
-      self.genconfig_dir.mkdir()
+  @staticmethod
+  def get_kernel_dir(reviewer):
+    if reviewer.git_dir:
+      return Path(reviewer.git_dir)
+    return Path()
 
   def is_config_change(self, patch):
       # Running the kernelconfig script is a little slow, so for now
       # only do it on CLs that have changed the configs.
       return '+++ b/chromeos/config' in patch
 
-  def create_kernel_configs(self):
-      cmd = [str(self.config_cmd), 'genconfig']
+  def create_kernel_configs(self, kernel_dir):
+      genconfig_dir = kernel_dir.joinpath('CONFIGS')
+      if not genconfig_dir.is_dir():
+        genconfig_dir.mkdir()
+
+      cmd = [str(kernel_dir.joinpath('chromeos/scripts/kernelconfig')),
+             'genconfig']
       logger.debug('Running {}'.format(' '.join(cmd)))
 
-      subprocess.call(cmd, stdout=subprocess.DEVNULL,
+      subprocess.call(cmd, cwd=str(kernel_dir), stdout=subprocess.DEVNULL,
                       stderr=subprocess.DEVNULL)
 
-  def move_genconfigs(self, dest):
-    logger.debug('Moving configs {}->{}'.format(self.genconfig_dir, dest))
+  def generate_configs(self, repo, commit):
+    # Checks out commit in repo and returns the generated configs, as
+    # {config file: {symbol: value}}
+    kernel_dir = self.get_kernel_dir(repo)
+    genconfig_dir = kernel_dir.joinpath('CONFIGS')
+
+    repo.checkout_reset('chromeos/config')
+    repo.checkout(commit)
+    self.create_kernel_configs(kernel_dir)
+
+    configs = {}
+    for filename in genconfig_dir.glob('*.config'):
+      configs[filename.name] = parse_config(filename.read_text())
+
+    repo.checkout_reset('chromeos/config')
+    self.rmdir_recursive(str(genconfig_dir))
+    return configs
+
+  def get_baseline_key(self, commit):
+    # genconfig resolves Kconfig defaults and dependencies from the whole tree,
+    # so the configs are keyed on it. CLs with the same parent (and the CLs
+    # of a stack, whose trees are the next one's parent tree) share a baseline
+    tree = self.reviewer.resolve('{}^{{tree}}'.format(commit))
+    if not tree:
+      return None
+    return (tree, ['genconfig-symbols'])
+
+  def get_cached_configs(self, commit):
+    key = self.get_baseline_key(commit) if self.config_cache else None
+    cached = self.config_cache.get(*key) if key else None
+    if cached is None:
+      return None
+    logger.debug('Using cached configs for {}'.format(commit))
+    return json.loads(cached)
+
+  def cache_configs(self, commit, configs):
+    key = self.get_baseline_key(commit) if self.config_cache else None
+    if key:
+      self.config_cache.put(*key, json.dumps(configs))
+
+  def diff_configs(self, orig, new):
+    # Returns {config file: [change]} for the files which differ, where a
+    # change is the tuple of diff lines for one symbol
+    ret = {}
+    for name in sorted(set(orig.keys()) | set(new.keys())):
+      if name not in orig:
+        ret[name] = [('Only in configs_new',)]
+        continue
+      if name not in new:
+        ret[name] = [('Only in configs_orig',)]
+        continue
 
-    if not dest.is_dir():
-      dest.mkdir()
-    for filename in self.genconfig_dir.glob('*.config'):
-      shutil.copy(str(filename), str(dest))
+      a = orig[name]
+      b = new[name]
+      changes = []
+      for symbol in sorted(set(a.keys()) | set(b.keys())):
+        if symbol in a and symbol in b and a[symbol] == b[symbol]:
+          continue
+        lines = []
+        if symbol in a:
+          lines.append('-' + format_config(symbol, a[symbol]))
+        if symbol in b:
+          lines.append('+' + format_config(symbol, b[symbol]))
+        changes.append(tuple(lines))
+      if changes:
+        ret[name] = changes
+    return ret
+
+  def format_config_diff(self, diff):
+    # A change made to several config files (ie: a common fragment changed for
+    # all flavours) is only listed once, under all of their names
+    files = collections.OrderedDict()
+    for name, changes in diff.items():
+      for change in changes:
+        files.setdefault(change, []).append(name)
+
+    groups = collections.OrderedDict()
+    for change, names in files.items():
+      groups.setdefault(tuple(names), []).append(change)
+
+    ret = []
+    for names, changes in groups.items():
+      ret.append('')
+      ret.append('{}:'.format(', '.join(names)))
+      for change in changes:
+        ret.extend(change)
+    return '\n'.join(ret)
 
   def rmdir_recursive(self, dir):
     logger.debug('Deleting {}'.format(dir))
@@ -50,76 +157,78 @@ class KernelConfigChecker():
     retry = 4
     for i in range(0, retry):
       try:
-        tmp_ref = self.reviewer.fetch_to_tmp_ref(remote, ref)
-        return tmp_ref
+        self.reviewer.fetch_commit(remote, ref, commit)
+        return commit
 
       except:
         if i == retry - 1:
           raise
         continue
 
-  def streamline_hunks(self, patch):
-      patch = patch.splitlines() or []
-      ret = []
-      # The config files are always sorted, so the hunk headers with their
-      # line numbers and line counts are not super necessary, and pretty
-      # distracting. Minimize things for better readability.
-      for line in patch:
-        if line.startswith('@@ '):
-          pass
-
-        elif line.startswith('diff '):
-          pass
-
-        elif line.startswith('--- '):
-          pass
-
-        elif line.startswith('+++ '):
-            line = line.split()[1]
-            if line.startswith('configs_new/'):
-                line = line[len('configs_new/'):] + ':'
-
-            ret.append('')
-            ret.append(line)
-
+  def verify_native_configs(self, commit, configs):
+    mismatches = self.merger.compare(self.merger.merge(commit), configs)
+    if not mismatches:
+      logger.debug('Native configs match for {}'.format(commit))
+      return True
+
+    logger.warning('Native configs differ for {} in {} places'.format(
+                   commit, len(mismatches)))
+    for name, symbol, native, generated in mismatches[:20]:
+      logger.warning('   {} {}: native={} genconfig={}'.format(name, symbol,
+                                                              native, generated))
+    return False
+
+  def get_kernel_configs(self, remote, ref, commit):
+    commit = self.fetch_commit(remote, ref, commit)
+
+    if self.generator == 'native':
+      # Everything is read from the object store, no checkout needed
+      orig = self.merger.merge('{}~1'.format(commit))
+      new = self.merger.merge(commit)
+      return self.format_config_diff(self.diff_configs(orig, new))
+
+    if self.worktrees:
+      # The worktree is ours alone until we're done, so other reviews (and
+      # config generation for other CLs) can carry on in parallel
+      with self.worktrees.acquire(commit) as worktree:
+        return self.__get_kernel_configs(worktree, commit)
+
+    # This checks out other commits in the local repo, so keep other reviews
+    # from running git underneath us until we're done
+    with self.reviewer.lock:
+      # Reset the working directory back to a pristine state.
+      self.reviewer.checkout_reset('.')
+      return self.__get_kernel_configs(self.reviewer, commit)
+
+  def __get_kernel_configs(self, repo, commit):
+    # Generate the full kernel configs for the tree just before the CL, unless
+    # they've been generated already, and for the CL
+    parent = '{}~1'.format(commit)
+    orig = self.get_cached_configs(parent)
+    if orig is not None:
+      new = self.generate_configs(repo, commit)
+    elif self.worktrees:
+      # If there's a spare worktree, generate both sides at once
+      with self.worktrees.acquire(parent, block=False) as other:
+        if other:
+          with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self.generate_configs, other, parent)
+            new = self.generate_configs(repo, commit)
+            orig = future.result()
         else:
-          ret.append(line)
-
-      return '\n'.join(ret)
-
-  def get_kernel_configs(self, remote, ref):
-    # Reset the working directory back to a pristine state.
-    self.reviewer.checkout_reset('.')
-
-    # Check out the tree just before the CL, and generate the full
-    # kernel configs.
-    tmp_ref = self.fetch_commit(remote, ref)
-
-    self.reviewer.checkout('{}~1'.format(tmp_ref))
-    self.create_kernel_configs()
-    orig_dir = self.kernel_dir.joinpath('configs_orig')
-    self.move_genconfigs(orig_dir)
-
-    # Now check out the CL, and generate the full configs.
-    self.reviewer.checkout_reset('chromeos/config')
-    self.reviewer.checkout(tmp_ref)
-    self.create_kernel_configs()
-    new_dir = self.kernel_dir.joinpath('configs_new')
-    self.move_genconfigs(new_dir)
-
-    self.reviewer.delete_ref(tmp_ref)
-
-    # Compare the two configs against each other.
-    cmd = ['diff', '-ru0', 'configs_orig', 'configs_new']
-    logger.debug('Running {}'.format(' '.join(cmd)))
-
-    proc = subprocess.Popen(cmd, cwd=str(self.kernel_dir), stdout=subprocess.PIPE)
-    kconfig_diff = proc.communicate()[0].decode('UTF-8')
-    kconfig_diff = self.streamline_hunks(kconfig_diff)
-
-    # Clean up
-    self.reviewer.checkout_reset('chromeos/config')
-    self.rmdir_recursive(str(orig_dir))
-    self.rmdir_recursive(str(new_dir))
-    self.rmdir_recursive(str(self.genconfig_dir))
-    return kconfig_diff
+          orig = self.generate_configs(repo, parent)
+          new = self.generate_configs(repo, commit)
+      self.cache_configs(parent, orig)
+    else:
+      orig = self.generate_configs(repo, parent)
+      new = self.generate_configs(repo, commit)
+      self.cache_configs(parent, orig)
+
+    # This is the baseline for the next CL in a stack
+    self.cache_configs(commit, new)
+
+    if self.generator == 'verify':
+      self.verify_native_configs(parent, orig)
+      self.verify_native_configs(commit, new)
+
+    return self.format_config_diff(self.diff_configs(orig, new))
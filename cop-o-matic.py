@@ -2,9 +2,9 @@
 
 import argparse
 import logging
-import subprocess
 import sys
 
+from reviewer import CallType
 from reviewer import Reviewer
 from trollconfig import TrollConfig
 from trollreviewer import ChangeReviewer
@@ -67,34 +67,19 @@ def do_review(project, change, verbose):
     return 0 if review.vote >= 0 else 42
 
 
-def get_change(ref):
-    sha1 = (
-        subprocess.check_output(["git", "log", "--format=%H", "-1", ref])
-        .decode("utf-8")
-        .strip()
+def get_change(reviewer, ref):
+    commit = reviewer.get_commit(ref)
+    if not commit:
+        raise ValueError("Could not find commit {}".format(ref))
+    patch = reviewer.git(["show", ref], CallType.CHECK_OUTPUT).strip()
+    return Change(
+        commit.sha,
+        commit.subject,
+        commit.body.strip(),
+        patch,
+        commit.committer_name,
+        commit.committer_email,
     )
-    subject = (
-        subprocess.check_output(["git", "log", "--format=%s", "-1", ref])
-        .decode("utf-8")
-        .strip()
-    )
-    commit_message = (
-        subprocess.check_output(["git", "log", "--format=%b", "-1", ref])
-        .decode("utf-8")
-        .strip()
-    )
-    patch = subprocess.check_output(["git", "show", ref]).decode("utf-8").strip()
-    name = (
-        subprocess.check_output(["git", "log", "--format=%cn", "-1", ref])
-        .decode("utf-8")
-        .strip()
-    )
-    email = (
-        subprocess.check_output(["git", "log", "--format=%ce", "-1", ref])
-        .decode("utf-8")
-        .strip()
-    )
-    return Change(sha1, subject, commit_message, patch, name, email)
 
 
 def main():
@@ -114,7 +99,7 @@ def main():
     config = TrollConfig(args.config)
     project = config.get_project(args.project)
 
-    change = get_change(args.ref)
+    change = get_change(Reviewer(verbose=args.verbose), args.ref)
 
     return do_review(project, change, args.verbose)
 
@@ -0,0 +1,144 @@
+import difflib
+import logging
+
+logger = logging.getLogger('rom.diffengine')
+
+class DiffEngine(object):
+  '''
+  Compares two lists of lines, yielding difflib.Differ style lines. Each line
+  is prefixed with a two character margin: '  ' for unchanged lines, '- ' for
+  lines only in a and '+ ' for lines only in b.
+  '''
+  def compare(self, a, b):
+    raise NotImplementedError()
+
+class DifferDiffEngine(DiffEngine):
+  '''
+  The reference engine. difflib.Differ is quadratic (or worse) and spends most
+  of its time on intraline '?' hints, so prefer MyersDiffEngine for real work.
+  '''
+  def compare(self, a, b):
+    return difflib.Differ().compare(a, b)
+
+class MyersDiffEngine(DiffEngine):
+  '''
+  Linear space Myers diff, O((N+M)D) where D is the number of changed lines.
+  Lines are interned to integers up front so the inner loops only compare
+  ints, and changed runs are emitted as deletions followed by insertions.
+  There is no intraline pass, so no '?' hint lines are generated.
+  '''
+  def compare(self, a, b):
+    ids = {}
+    a_ids = [ids.setdefault(l, len(ids)) for l in a]
+    b_ids = [ids.setdefault(l, len(ids)) for l in b]
+
+    # Lines which only appear on one side can never match, so drop them before
+    # diffing. This keeps wholesale rewrites from costing O(N*D).
+    in_a = set(a_ids)
+    in_b = set(b_ids)
+    a_idx = [i for i, l in enumerate(a_ids) if l in in_b]
+    b_idx = [j for j, l in enumerate(b_ids) if l in in_a]
+    a_ids = [a_ids[i] for i in a_idx]
+    b_ids = [b_ids[j] for j in b_idx]
+
+    matches = []
+    self.__diff(a_ids, b_ids, 0, len(a_ids), 0, len(b_ids), matches)
+
+    i = 0
+    j = 0
+    for x, y in matches:
+      x = a_idx[x]
+      y = b_idx[y]
+      for l in a[i:x]:
+        yield '- ' + l
+      for l in b[j:y]:
+        yield '+ ' + l
+      yield '  ' + a[x]
+      i = x + 1
+      j = y + 1
+    for l in a[i:]:
+      yield '- ' + l
+    for l in b[j:]:
+      yield '+ ' + l
+
+  def __diff(self, a, b, alo, ahi, blo, bhi, matches):
+    # Peel off the common prefix and suffix, these are cheap and very common
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+      matches.append((alo, blo))
+      alo += 1
+      blo += 1
+    suffix = 0
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+      ahi -= 1
+      bhi -= 1
+      suffix += 1
+
+    if alo < ahi and blo < bhi:
+      x, y, u, v = self.__middle_snake(a, b, alo, ahi, blo, bhi)
+      self.__diff(a, b, alo, x, blo, y, matches)
+      matches.extend(zip(range(x, u), range(y, v)))
+      self.__diff(a, b, u, ahi, v, bhi, matches)
+
+    matches.extend(zip(range(ahi, ahi + suffix), range(bhi, bhi + suffix)))
+
+  @staticmethod
+  def __middle_snake(a, b, alo, ahi, blo, bhi):
+    # Find the middle snake of the shortest edit script by searching forwards
+    # from the start and backwards from the end until the paths overlap. The
+    # snake is returned as absolute (x, y, u, v), with a[x:u] == b[y:v].
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2
+    off = max_d + 1
+    vf = [0] * (2 * off + 1)
+    vb = [0] * (2 * off + 1)
+
+    for d in range(max_d + 1):
+      for k in range(-d, d + 1, 2):
+        if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+          x = vf[off + k + 1]
+        else:
+          x = vf[off + k - 1] + 1
+        y = x - k
+        x0, y0 = x, y
+        while x < n and y < m and a[alo + x] == b[blo + y]:
+          x += 1
+          y += 1
+        vf[off + k] = x
+        if odd and -d < delta - k < d and x + vb[off + delta - k] >= n:
+          return (alo + x0, blo + y0, alo + x, blo + y)
+
+      for k in range(-d, d + 1, 2):
+        if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+          x = vb[off + k + 1]
+        else:
+          x = vb[off + k - 1] + 1
+        y = x - k
+        x0, y0 = x, y
+        while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+          x += 1
+          y += 1
+        vb[off + k] = x
+        if (not odd and -d <= delta - k <= d and
+            x + vf[off + delta - k] >= n):
+          return (ahi - x, bhi - y, ahi - x0, bhi - y0)
+
+    raise ValueError('Could not find middle snake')
+
+def diff_lines(engine, a, b):
+  # Module level so it can be handed to a process pool
+  return list(engine.compare(a, b))
+
+DIFF_ENGINES = {
+  'myers': MyersDiffEngine,
+  'differ': DifferDiffEngine,
+}
+
+def get_diff_engine(name):
+  engine = DIFF_ENGINES.get(name)
+  if not engine:
+    raise ValueError('Invalid diff engine "{}", choose from {}'.format(
+                     name, ', '.join(DIFF_ENGINES.keys())))
+  return engine()
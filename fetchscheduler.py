@@ -0,0 +1,71 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger('rom.fetch')
+
+class FetchScheduler(object):
+  '''
+  Coalesces remote fetches. A (repo, remote, ref) fetched less than freshness
+  seconds ago isn't fetched again, unless the commit we're after isn't on it
+  yet. Concurrent fetches of the same ref wait for the first one, and only
+  fetch again if it didn't bring in their commit. Fetch counts and times are
+  kept per remote.
+  '''
+  def __init__(self, freshness=300):
+    self.freshness = freshness
+    self.lock = threading.Lock()
+    self.key_locks = {}
+    self.last_fetch = {}
+    # remote: [fetches, total seconds, skipped (fresh), skipped (present)]
+    self.stats = collections.defaultdict(lambda: [0, 0.0, 0, 0])
+
+  def __get_key_lock(self, key):
+    with self.lock:
+      if key not in self.key_locks:
+        self.key_locks[key] = threading.Lock()
+      return self.key_locks[key]
+
+  def fetch(self, reviewer, ref):
+    key = (reviewer.git_dir, ref.remote, ref.refs())
+    with self.__get_key_lock(key):
+      # The remote-tracking branch is also used for other lookups (ie: Fixes:
+      # references), so it's refreshed once it goes stale even when the commit
+      # we're after is already on it. A missing commit is always fetched, it
+      # may have landed since the last fetch.
+      with self.lock:
+        last = self.last_fetch.get(key)
+      if last is not None and time.monotonic() - last < self.freshness:
+        if not ref.sha:
+          logger.debug('Skipping fetch, recently fetched {}'.format(str(ref)))
+          with self.lock:
+            self.stats[ref.remote_name][2] += 1
+          return 0
+        # If we waited on another fetch of this ref, it may have brought in
+        # what we're after
+        if reviewer.is_sha_in_branch(ref, skip_err=True):
+          logger.debug('Skipping fetch, already have {}'.format(str(ref)))
+          with self.lock:
+            self.stats[ref.remote_name][3] += 1
+          return 0
+
+      start = time.monotonic()
+      ret = reviewer.fetch_remote_now(ref)
+      end = time.monotonic()
+      with self.lock:
+        # Failed fetches aren't considered fresh, try again next time
+        if ret == 0:
+          self.last_fetch[key] = end
+        stats = self.stats[ref.remote_name]
+        stats[0] += 1
+        stats[1] += end - start
+      return ret
+
+  def summarize(self, level):
+    with self.lock:
+      stats = {r: list(s) for r, s in self.stats.items()}
+    logger.log(level, 'Remote fetches:')
+    for remote, (num, secs, fresh, present) in sorted(stats.items()):
+      logger.log(level, '   {}: fetches={} time={:.1f}s skipped_fresh={} '
+                 'skipped_present={}'.format(remote, num, secs, fresh, present))
@@ -1,4 +1,6 @@
+import base64
 from datetime import datetime
+from httpsession import get_http_session
 import json
 import logging
 from logging import handlers
@@ -6,6 +8,7 @@ import os
 from pygerrit2 import GerritRestAPI, Anonymous, HTTPBasicAuthFromNetrc
 import pprint
 import requests
+import threading
 import urllib
 
 logger = logging.getLogger('rom')
@@ -66,8 +69,9 @@ class GerritRevision(object):
     self.id = id
     self.ref = rest['ref']
     self.number = rest['_number']
-    self.uploader_name = ''.join(rest['uploader']['name'])
-    self.uploader_email = ''.join(rest['uploader']['email'])
+    # Names and emails are only present when DETAILED_ACCOUNTS is requested
+    self.uploader_name = ''.join(rest['uploader'].get('name', ''))
+    self.uploader_email = ''.join(rest['uploader'].get('email', ''))
     if rest.get('commit_with_footers'):
       self.commit_message = ''.join(rest['commit_with_footers'])
 
@@ -87,7 +91,8 @@ class GerritChange(object):
     self.id = rest['id']
     self.change_id = rest['change_id']
     self.number = rest['_number']
-    # yyyy-mm-dd hh:mm:ss.fffffffff
+    # yyyy-mm-dd hh:mm:ss.fffffffff, the raw string keeps the sub-second part
+    self.updated = rest['updated']
     self.last_updated = parse_gerrit_timestamp(rest['updated'])
     self.status = rest['status']
     self.subject = rest['subject']
@@ -102,8 +107,11 @@ class GerritChange(object):
     for r in rest['revisions']:
       self.revisions.append(GerritRevision(r, rest['revisions'][r]))
 
+    # Summary queries don't request MESSAGES (or labels), see
+    # Gerrit.summary_options
+    self.detailed = 'messages' in rest
     self.messages = {}
-    for m in rest['messages']:
+    for m in rest.get('messages', []):
       msg = GerritMessage(m)
       self.messages[msg.id] = msg
 
@@ -177,13 +185,66 @@ class Gerrit(object):
       logger.debug('No netrc specified. Using Gerrit anonymously.')
       auth = Anonymous()
     self.timeout = 90
+    self.page_size = 100
     self.rest = GerritRestAPI(url=url, auth=auth)
+    # Auth is passed per request by GerritRestAPI, so the pooled session can
+    # be shared between clients
+    self.rest.session = get_http_session().session
     self.url = url
     self.change_options = ['CURRENT_REVISION', 'MESSAGES', 'DETAILED_LABELS',
                            'DETAILED_ACCOUNTS', 'COMMIT_FOOTERS']
+    # Enough to identify a change, its current revision and when it was last
+    # updated, without the (large) messages and votes
+    self.summary_options = ['CURRENT_REVISION']
+
+    # Fully parsed changes from get_change, keyed by change number. The ids
+    # callers have used to look them up are mapped to the number.
+    self.change_cache = {}
+    self.change_cache_ids = {}
+    self.change_cache_lock = threading.Lock()
+
+  def __get_cached_change(self, change_id):
+    with self.change_cache_lock:
+      number = self.change_cache_ids.get(str(change_id))
+      cached = self.change_cache.get(number)
+    if not cached:
+      return None
+
+    # A change without any options is a cheap way to get the last update time.
+    # Any new revision, vote, message or status change will bump it.
+    uri = '/changes/{}'.format(change_id)
+    rest = self.rest.get(uri, timeout=self.timeout)
+    if rest['_number'] == cached.number and rest['updated'] == cached.updated:
+      return cached
+
+    self.invalidate_change(cached.number)
+    return None
+
+  def __cache_change(self, change_id, change):
+    with self.change_cache_lock:
+      self.change_cache[change.number] = change
+      for i in (change_id, change.number, change.id):
+        self.change_cache_ids[str(i)] = change.number
+
+  def invalidate_change(self, change=None):
+    # Drop a change (GerritChange or number) from the cache, or everything if
+    # no change is given
+    with self.change_cache_lock:
+      if change is None:
+        self.change_cache = {}
+        self.change_cache_ids = {}
+        return
+      number = change.number if isinstance(change, GerritChange) else change
+      self.change_cache.pop(int(number), None)
 
   def get_change(self, change_id, rev_num=None):
-    options = self.change_options
+    # Rolling back to a previous revision isn't cached, it's only for testing
+    if rev_num == None:
+      c = self.__get_cached_change(change_id)
+      if c:
+        return c
+
+    options = list(self.change_options)
     if rev_num != None:
       options += ['ALL_REVISIONS']
     uri = '/changes/{}?o={}'.format(change_id, '&o='.join(options))
@@ -210,50 +271,92 @@ class Gerrit(object):
     #pprint.PrettyPrinter(indent=4).pprint(rest)
     c.add_comments(rest)
 
+    if rev_num == None:
+      self.__cache_change(change_id, c)
     return c
 
-  def get_ancestor_changes(self, change):
+  def get_ancestor_changes(self, change, chunk_size=50):
     uri = '/changes/{}/revisions/current/related'.format(change.id)
     related_changes = self.rest.get(uri, timeout=self.timeout)['changes']
-    changes = []
-    parents = []
 
+    # Index the related changes by commit so walking up the chain is linear
+    by_commit = {}
+    parents = []
     for c in related_changes:
+      by_commit[c['commit']['commit']] = c
       if c['change_id'] == change.change_id:
         parents = c['commit']['parents']
-        break
 
-    while True:
+    numbers = []
+    seen = set()
+    while parents:
       new_parents = []
       for p in parents:
-        for c in related_changes:
-          if c['commit']['commit'] == p['commit']:
-            new_parents += c['commit']['parents']
-            changes.append(self.get_change(c['_change_number']))
-            break
-      if new_parents:
-        parents = new_parents
-      else:
-        break
-
+        c = by_commit.get(p['commit'])
+        if not c or c['commit']['commit'] in seen:
+          continue
+        seen.add(c['commit']['commit'])
+        new_parents += c['commit']['parents']
+        numbers.append(c['_change_number'])
+      parents = new_parents
+
+    changes = self.get_changes(numbers, chunk_size)
+    ret = []
+    for n in numbers:
+      if n not in changes:
+        logger.error('Could not fetch ancestor change {}'.format(n))
+        continue
+      ret.append(changes[n])
+    return ret
+
+  def get_changes(self, numbers, chunk_size=50, options=None):
+    # Fetches the changes in chunks of 'change:A OR change:B ...' queries rather
+    # than one get_change (and its 2+ requests) per change. Returns a dict of
+    # {number: change}, changes which couldn't be found are left out.
+    changes = {}
+    numbers = list(numbers)
+    for i in range(0, len(numbers), chunk_size):
+      chunk = numbers[i:i + chunk_size]
+      for c in self.query_changes(change_num=chunk, page_size=len(chunk),
+                                  options=options):
+        changes[c.number] = c
     return changes
 
   def query_changes(self, status=None, message=None, after=None, age_days=None,
                     change_id=None, change_num=None, project=None, owner=None,
-                    branches=None):
+                    branches=None, page_size=None, options=None):
+    # This is a generator, results are fetched page_size changes at a time as
+    # they're consumed. options defaults to change_options.
     query = []
     if message:
-      query.append('message:"{}"'.format(urllib.parse.quote(message)))
+      # A list of messages is OR'd together, matching any of them
+      if isinstance(message, str):
+        message = [message]
+      terms = ['message:"{}"'.format(urllib.parse.quote(m)) for m in message]
+      if len(terms) == 1:
+        query.append(terms[0])
+      else:
+        query.append('({})'.format(' OR '.join(terms)))
     if status:
       query.append('status:{}'.format(status))
     if after:
-      query.append('after:"{}"'.format(after.isoformat()))
+      # Gerrit wants 'YYYY-MM-DD[ HH:MM:SS]', in UTC
+      if isinstance(after, datetime):
+        after = after.strftime('%Y-%m-%d %H:%M:%S')
+      else:
+        after = after.isoformat()
+      query.append('after:"{}"'.format(urllib.parse.quote(after)))
     if age_days:
       query.append('age:{}d'.format(age_days))
     if change_id:
       query.append('change:{}'.format(change_id))
     if change_num:
-      query.append('change:{}'.format(change_num))
+      # A list of change numbers is OR'd together, matching any of them
+      if isinstance(change_num, (list, tuple)):
+        query.append('({})'.format(
+                     ' OR '.join(['change:{}'.format(n) for n in change_num])))
+      else:
+        query.append('change:{}'.format(change_num))
     if project:
       query.append('project:{}'.format(project))
     if owner:
@@ -268,16 +371,28 @@ class Gerrit(object):
       query.append(q)
 
     uri = '/changes/?q={}&o={}'.format('+'.join(query),
-                                       '&o='.join(self.change_options))
-    changes = []
-    for c in self.rest.get(uri, timeout=self.timeout):
-      changes.append(GerritChange(self.url, c))
-    return changes
+                                       '&o='.join(options or
+                                                  self.change_options))
+    page_size = page_size or self.page_size
+    start = 0
+    while True:
+      page_uri = '{}&n={}&S={}'.format(uri, page_size, start)
+      rest = self.rest.get(page_uri, timeout=self.timeout)
+      for c in rest:
+        yield GerritChange(self.url, c)
+
+      # Gerrit marks the last change of a page if there are more to come
+      if not rest or not rest[-1].get('_more_changes'):
+        break
+      start += len(rest)
 
   def get_patch(self, change):
+    # Returns the current revision as `git format-patch` output, gerrit sends
+    # it base64 encoded
     uri = '/changes/{}/revisions/{}/patch'.format(change.id,
                                                   change.current_revision.id)
-    return self.rest.get(uri, timeout=self.timeout)
+    rest = self.rest.get(uri, timeout=self.timeout)
+    return base64.b64decode(rest).decode('UTF-8', errors='replace')
 
   def get_messages(self, change):
     uri = '/changes/{}/messages'.format(change.id)
@@ -289,6 +404,7 @@ class Gerrit(object):
     options = {
         'topic': change.topic
     }
+    self.invalidate_change(change)
     try:
       self.rest.put(uri, data=options, timeout=self.timeout)
       return True
@@ -300,6 +416,7 @@ class Gerrit(object):
     options = {
         'notify': 'NONE',
     }
+    self.invalidate_change(change)
     try:
       self.rest.post(uri, data=options, timeout=self.timeout)
       return True
@@ -308,6 +425,7 @@ class Gerrit(object):
 
   def abandon(self, change):
     uri = '/changes/{}/abandon'.format(change.id)
+    self.invalidate_change(change)
     try:
       self.rest.post(uri, timeout=self.timeout)
       return True
@@ -341,6 +459,7 @@ class Gerrit(object):
     #pprint.PrettyPrinter(indent=4).pprint(json.dumps(review))
     uri = "changes/{}/revisions/{}/review".format(change.id,
                                                   change.current_revision.id)
+    self.invalidate_change(change)
     return self.rest.post(uri, data=json.dumps(review),
                           headers={"Content-Type": "application/json"},
                           timeout=self.timeout)
@@ -0,0 +1,120 @@
+import json
+import logging
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('rom.gerritwatch')
+
+class GerritEventStream(object):
+  '''
+  Reads gerrit stream-events JSON (one event per line) from a command, such as
+  `ssh -p 29418 <host> gerrit stream-events`. Anything which prints events in
+  the same format, like a local stub script, can stand in for gerrit.
+  '''
+  def __init__(self, cmd):
+    self.cmd = shlex.split(cmd) if isinstance(cmd, str) else cmd
+    self.events = queue.Queue()
+    self.proc = None
+    self.thread = None
+
+  def start(self):
+    logger.debug('Streaming events from {}'.format(' '.join(self.cmd)))
+    self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+    self.thread = threading.Thread(target=self.__read_events, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    if self.proc:
+      self.proc.kill()
+      self.proc.wait()
+      self.proc = None
+
+  def is_alive(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def __read_events(self):
+    for l in self.proc.stdout:
+      try:
+        event = json.loads(l.decode('UTF-8'))
+      except ValueError:
+        logger.warning('Ignoring malformed event "{}"'.format(l))
+        continue
+      self.events.put(event)
+    logger.warning('Event stream ended')
+
+  @staticmethod
+  def get_change_number(event):
+    change = event.get('change')
+    if not change or change.get('number') is None:
+      return None
+    return int(change['number'])
+
+  def wait_for_event(self, numbers, timeout):
+    # Waits up to timeout seconds for an event on one of the change numbers,
+    # returning True if one arrived
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      try:
+        event = self.events.get(timeout=remaining)
+      except queue.Empty:
+        return False
+      number = self.get_change_number(event)
+      if number in numbers:
+        logger.debug('Got {} event for {}'.format(event.get('type'), number))
+        return True
+
+
+class ChangeWatcher(object):
+  '''
+  Watches a set of changes until one of them needs action. The whole set is
+  checked with one batched query per interval, backing off while nothing
+  happens. If an event stream is given, an event on a watched change triggers
+  a check immediately rather than waiting out the interval. Polls back off to
+  poll_max_interval, the longer max_interval only applies while the event
+  stream is alive to cut them short.
+  '''
+  # Status and votes are all that's needed to decide on action, messages and
+  # account details are left out to keep the repeated queries light
+  OPTIONS = ['CURRENT_REVISION', 'DETAILED_LABELS']
+
+  def __init__(self, gerrit, min_interval=15, max_interval=300,
+               poll_max_interval=60, events=None, chunk_size=50):
+    self.gerrit = gerrit
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.poll_max_interval = poll_max_interval
+    self.events = events
+    self.chunk_size = chunk_size
+
+  def query(self, numbers):
+    changes = self.gerrit.get_changes(numbers, chunk_size=self.chunk_size,
+                                      options=self.OPTIONS)
+    return list(changes.values())
+
+  def wait(self, changes, needs_action):
+    numbers = [c.number for c in changes]
+    if not numbers:
+      return []
+
+    interval = self.min_interval
+    while True:
+      ready = [c for c in self.query(numbers) if needs_action(c)]
+      if ready:
+        return ready
+
+      if self.events and self.events.is_alive():
+        if self.events.wait_for_event(set(numbers), interval):
+          interval = self.min_interval
+          continue
+        interval = min(interval * 2, self.max_interval)
+      else:
+        interval = min(interval, self.poll_max_interval)
+        time.sleep(interval)
+        interval = min(interval * 2, self.poll_max_interval)
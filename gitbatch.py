@@ -0,0 +1,185 @@
+import collections
+import logging
+import subprocess
+import threading
+
+logger = logging.getLogger('rom.gitbatch')
+
+GitObject = collections.namedtuple('GitObject', ['sha', 'type', 'size',
+                                                 'data'])
+
+GitCommit = collections.namedtuple('GitCommit',
+                                   [
+                                     'sha',
+                                     'tree',
+                                     'parents',
+                                     'author_name',
+                                     'author_email',
+                                     'committer_name',
+                                     'committer_email',
+                                     'subject',
+                                     'body',
+                                     'message',
+                                   ])
+
+GitTreeEntry = collections.namedtuple('GitTreeEntry', ['mode', 'name', 'sha'])
+
+class GitBatchProcess(object):
+  '''
+  A long-lived `git cat-file --batch` (or --batch-check) coprocess. Requests
+  are written to stdin one object name per line and answered on stdout, so
+  lookups cost a pipe round trip instead of a fork/exec and index load.
+  '''
+  def __init__(self, git_cmd, mode):
+    self.cmd = git_cmd + ['cat-file', '--{}'.format(mode)]
+    self.mode = mode
+    self.proc = None
+    self.lock = threading.Lock()
+
+  def __start(self):
+    logger.debug('GIT: {}'.format(' '.join(self.cmd)))
+    self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+
+  def __request(self, name):
+    if not self.proc or self.proc.poll() is not None:
+      self.__start()
+
+    self.proc.stdin.write('{}\n'.format(name).encode('UTF-8'))
+    self.proc.stdin.flush()
+
+    header = self.proc.stdout.readline().decode('UTF-8').split()
+    if not header:
+      raise BrokenPipeError('git cat-file exited unexpectedly')
+    # <name> missing / <name> ambiguous
+    if len(header) != 3:
+      return None
+
+    sha, obj_type, size = header[0], header[1], int(header[2])
+    data = None
+    if self.mode == 'batch':
+      data = self.proc.stdout.read(size)
+      self.proc.stdout.read(1) # trailing newline
+    return GitObject(sha, obj_type, size, data)
+
+  def request(self, name):
+    # Object names can't contain newlines, and an empty request would make
+    # cat-file wait for more input
+    if not name or '\n' in name:
+      return None
+
+    with self.lock:
+      try:
+        return self.__request(name)
+      except (BrokenPipeError, OSError) as e:
+        # The coprocess went away (repo gc, killed, etc), restart it and try
+        # once more before giving up
+        logger.warning('git cat-file restarting: ({})'.format(e))
+        self.__close()
+        return self.__request(name)
+
+  def __close(self):
+    if not self.proc:
+      return
+    try:
+      self.proc.stdin.close()
+      self.proc.wait(timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+      self.proc.kill()
+    self.proc = None
+
+  def close(self):
+    with self.lock:
+      self.__close()
+
+
+class GitBatch(object):
+  def __init__(self, git_cmd):
+    self.batch = GitBatchProcess(git_cmd, 'batch')
+    self.batch_check = GitBatchProcess(git_cmd, 'batch-check')
+
+  def close(self):
+    self.batch.close()
+    self.batch_check.close()
+
+  def has_object(self, name):
+    return self.batch_check.request(name) is not None
+
+  def resolve(self, name):
+    obj = self.batch_check.request(name)
+    return obj.sha if obj else None
+
+  def get_object(self, name):
+    return self.batch.request(name)
+
+  def get_commit(self, name):
+    obj = self.get_object('{}^{{commit}}'.format(name))
+    if not obj or obj.type != 'commit':
+      return None
+    return self.parse_commit(obj.sha,
+                             obj.data.decode('UTF-8', errors='replace'))
+
+  def get_tree(self, name):
+    # Returns the entries of a tree (ie: 'HEAD:some/dir'), or None
+    obj = self.get_object(name)
+    if not obj or obj.type != 'tree':
+      return None
+    return self.parse_tree(obj.data)
+
+  def get_blob(self, name):
+    obj = self.get_object(name)
+    if not obj or obj.type != 'blob':
+      return None
+    return obj.data
+
+  @staticmethod
+  def parse_tree(raw):
+    # Each entry is '<octal mode> <name>\0<20 byte sha>'
+    entries = []
+    pos = 0
+    while pos < len(raw):
+      nul = raw.index(b'\0', pos)
+      mode, _, name = raw[pos:nul].partition(b' ')
+      sha = raw[nul + 1:nul + 21].hex()
+      entries.append(GitTreeEntry(mode.decode('UTF-8'),
+                                  name.decode('UTF-8', errors='replace'), sha))
+      pos = nul + 21
+    return entries
+
+  @staticmethod
+  def parse_ident(value):
+    # Name <email> timestamp tz
+    name, _, rest = value.partition(' <')
+    email = rest.split('>')[0]
+    return name, email
+
+  @staticmethod
+  def parse_commit(sha, raw):
+    headers, _, message = raw.partition('\n\n')
+    tree = None
+    parents = []
+    author = ('', '')
+    committer = ('', '')
+    for l in headers.split('\n'):
+      # Continuation of a multi-line header (ie: gpgsig)
+      if l.startswith(' '):
+        continue
+      key, _, value = l.partition(' ')
+      if key == 'tree':
+        tree = value
+      elif key == 'parent':
+        parents.append(value)
+      elif key == 'author':
+        author = GitBatch.parse_ident(value)
+      elif key == 'committer':
+        committer = GitBatch.parse_ident(value)
+
+    # Mimic git's %s and %b: the subject is the first paragraph joined onto
+    # one line, the body is everything after it
+    paragraphs = message.lstrip('\n').split('\n\n', 1)
+    subject = ' '.join(paragraphs[0].split('\n')).strip()
+    body = paragraphs[1].lstrip('\n') if len(paragraphs) > 1 else ''
+
+    return GitCommit(sha, tree, parents, author[0], author[1], committer[0],
+                     committer[1], subject, body, message)
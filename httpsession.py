@@ -0,0 +1,80 @@
+import collections
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import urllib
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('rom.http')
+
+class HttpSession(object):
+  '''
+  A pooled HTTP transport shared by the gerrit and patchwork clients. It keeps
+  connections alive between requests, caps the number of connections per host,
+  retries idempotent requests with exponential backoff, and keeps per-host
+  latency statistics.
+  '''
+  def __init__(self, max_hosts=16, max_per_host=4, retries=3, backoff=0.5,
+               timeout=90):
+    self.timeout = timeout
+    self.session = requests.Session()
+
+    # Only retry idempotent methods, we don't want to double-post a review.
+    # Once the retries run out the last response is returned as-is, so callers
+    # can check its status like they would without retries.
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False, respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_per_host,
+                          pool_block=True, max_retries=retry)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.session.hooks['response'].append(self.__record_latency)
+
+    self.lock = threading.Lock()
+    # host: [requests, total seconds, max seconds]
+    self.latency = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+  def __record_latency(self, response, *args, **kwargs):
+    host = urllib.parse.urlsplit(response.url).netloc
+    elapsed = response.elapsed.total_seconds()
+    with self.lock:
+      stats = self.latency[host]
+      stats[0] += 1
+      stats[1] += elapsed
+      stats[2] = max(stats[2], elapsed)
+
+  def get(self, url, **kwargs):
+    kwargs.setdefault('timeout', self.timeout)
+    return self.session.get(url, **kwargs)
+
+  def get_latency(self):
+    # Returns {host: (requests, average seconds, max seconds)}
+    with self.lock:
+      return {h: (s[0], s[1] / s[0], s[2]) for h, s in self.latency.items()}
+
+  def summarize(self, level):
+    logger.log(level, 'HTTP latency:')
+    for host, (num, avg, worst) in sorted(self.get_latency().items()):
+      logger.log(level, '   {}: requests={} avg={:.3f}s max={:.3f}s'.format(
+                 host, num, avg, worst))
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def configure_http_session(**kwargs):
+  # Replaces the shared session with one built from kwargs (see HttpSession),
+  # this should be called before any clients are created
+  global http_session
+  with http_session_lock:
+    http_session = HttpSession(**kwargs)
+    return http_session
+
+def get_http_session():
+  global http_session
+  with http_session_lock:
+    if not http_session:
+      http_session = HttpSession()
+    return http_session
@@ -0,0 +1,112 @@
+import logging
+import re
+
+logger = logging.getLogger('rom.kconfigmerge')
+
+# Matches 'CONFIG_FOO=value' and '# CONFIG_FOO is not set'
+CONFIG_LINE = re.compile(r'^(?:(CONFIG_\w+)=(.*)|# (CONFIG_\w+) is not set)$')
+
+def parse_config(text):
+  # Returns {symbol: value} for a .config (or fragment), symbols which are 'not
+  # set' have a value of None
+  ret = {}
+  for l in text.splitlines():
+    m = CONFIG_LINE.match(l.strip())
+    if not m:
+      continue
+    if m.group(1):
+      ret[m.group(1)] = m.group(2)
+    else:
+      ret[m.group(3)] = None
+  return ret
+
+def format_config(symbol, value):
+  if value is None:
+    return '# {} is not set'.format(symbol)
+  return '{}={}'.format(symbol, value)
+
+
+class KconfigFragmentMerger(object):
+  '''
+  Merges the kernel config fragments under chromeos/config straight from git
+  objects, without a checkout. For each architecture directory, every
+  <flavour>.flavour.config is layered on top of the arch's common.config, on
+  top of base.config, later fragments overriding earlier ones. The result is
+  named <arch>-<flavour>.flavour.config like genconfig's output.
+
+  Only the symbols set by the fragments are produced. Unlike genconfig, Kconfig
+  defaults and dependencies aren't evaluated, so symbols which can't be set
+  (or which are derived from others) won't match its output.
+  '''
+  BASE = 'base.config'
+  COMMON = 'common.config'
+  FLAVOUR_SUFFIX = '.flavour.config'
+
+  def __init__(self, reviewer, config_dir='chromeos/config'):
+    self.reviewer = reviewer
+    self.config_dir = config_dir
+
+  def __list(self, commit, path, blobs, dirs):
+    # Collects the blobs (path: sha) and directories below path
+    entries = self.reviewer.get_tree('{}:{}'.format(commit, path))
+    for e in entries or []:
+      child = '{}/{}'.format(path, e.name)
+      if e.mode == '40000':
+        dirs.append(child)
+        self.__list(commit, child, blobs, dirs)
+      else:
+        blobs[child] = e.sha
+
+  def merge(self, commit):
+    # Returns {config file: {symbol: value}} for commit
+    blobs = {}
+    dirs = []
+    self.__list(commit, self.config_dir, blobs, dirs)
+
+    # Fragments are shared between flavours, only parse them once
+    fragments = {}
+    def read(path):
+      if path not in blobs:
+        return {}
+      if path not in fragments:
+        data = self.reviewer.get_blob(blobs[path])
+        fragments[path] = parse_config(data.decode('UTF-8', errors='replace'))
+      return fragments[path]
+
+    configs = {}
+    for d in dirs:
+      parent, arch = d.rsplit('/', 1)
+      flavours = sorted(p for p in blobs if p.rsplit('/', 1)[0] == d and
+                        p.endswith(self.FLAVOUR_SUFFIX))
+      if not flavours:
+        continue
+
+      # The arch's base.config is the closest one above it
+      root = parent
+      while (root != self.config_dir and
+             '{}/{}'.format(root, self.BASE) not in blobs):
+        root = root.rsplit('/', 1)[0]
+
+      common = dict(read('{}/{}'.format(root, self.BASE)))
+      common.update(read('{}/{}'.format(d, self.COMMON)))
+      for f in flavours:
+        merged = dict(common)
+        merged.update(read(f))
+        configs['{}-{}'.format(arch, f.rsplit('/', 1)[1])] = merged
+    return configs
+
+  @staticmethod
+  def compare(native, generated):
+    # Returns a list of (config file, symbol, native value, generated value)
+    # where the merged fragments disagree with generated configs
+    MISSING = '<missing>'
+    ret = []
+    for name, symbols in sorted(native.items()):
+      if name not in generated:
+        ret.append((name, None, None, MISSING))
+        continue
+      for symbol, value in sorted(symbols.items()):
+        other = generated[name].get(symbol, MISSING)
+        if other != value:
+          ret.append((name, symbol, value, other))
+    return ret
@@ -19,15 +19,17 @@ def main():
   parser.add_argument('--owner', required=True, help='Address of owner')
   parser.add_argument('--review-score', default=None, type=int,
     help='Desired review score')
+  parser.add_argument('--page-size', default=None, type=int,
+    help='Number of changes to fetch from gerrit per request')
   args = parser.parse_args()
 
   gerrit = Gerrit('https://chromium-review.googlesource.com',
                        use_internal=False)
 
-  changes = gerrit.query_changes(owner=args.owner, status='open')
   output = defaultdict(list)
 
-  for c in changes:
+  for c in gerrit.query_changes(owner=args.owner, status='open',
+                                page_size=args.page_size):
     add = True
     if args.review_score != None:
       for r in c.vote_code_review:
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import zlib
+
+logger = logging.getLogger('rom.patchcache')
+
+class PatchCache(object):
+  '''
+  On-disk LRU cache of `git show` output. A commit's patch never changes for a
+  given sha and set of diff options, so entries never need invalidating, only
+  evicting. Anything else derived purely from git objects (like generated
+  kernel configs) can be cached the same way. Entries are zlib compressed, one
+  file per key, and the least recently used ones are removed once the cache
+  grows past max_bytes.
+  '''
+  SUFFIX = '.patch.z'
+
+  def __init__(self, path, max_bytes):
+    self.path = pathlib.Path(path)
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.sizes = {}
+    for f in self.path.glob('*{}'.format(self.SUFFIX)):
+      self.sizes[f.name] = f.stat().st_size
+    self.total_bytes = sum(self.sizes.values())
+
+  @staticmethod
+  def __key_name(sha, options):
+    key = '\0'.join([sha] + list(options))
+    return hashlib.sha256(key.encode('UTF-8')).hexdigest() + PatchCache.SUFFIX
+
+  def get(self, sha, options):
+    name = self.__key_name(sha, options)
+    path = self.path.joinpath(name)
+    with self.lock:
+      try:
+        data = path.read_bytes()
+        # Bump the mtime, this is what LRU eviction is based on
+        os.utime(str(path))
+      except FileNotFoundError:
+        self.misses += 1
+        self.sizes.pop(name, None)
+        return None
+      self.hits += 1
+
+    try:
+      return zlib.decompress(data).decode('UTF-8')
+    except zlib.error as e:
+      logger.error('Corrupt patch cache entry {}: ({})'.format(path, e))
+      return None
+
+  def put(self, sha, options, patch):
+    name = self.__key_name(sha, options)
+    data = zlib.compress(patch.encode('UTF-8'))
+    # Don't flush the whole cache for something that won't fit anyway
+    if len(data) > self.max_bytes:
+      return
+
+    with self.lock:
+      # Write to a temporary file and rename so readers never see a partial
+      # entry
+      fd, tmp = tempfile.mkstemp(dir=str(self.path), suffix='.tmp')
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.replace(tmp, str(self.path.joinpath(name)))
+
+      self.total_bytes += len(data) - self.sizes.get(name, 0)
+      self.sizes[name] = len(data)
+      if self.total_bytes > self.max_bytes:
+        self.__evict()
+
+  def __evict(self):
+    # Evict down to 90% so we're not evicting on every put once full
+    target = self.max_bytes * 0.9
+    entries = []
+    for name in self.sizes.keys():
+      try:
+        entries.append((self.path.joinpath(name).stat().st_mtime, name))
+      except FileNotFoundError:
+        entries.append((0, name))
+    entries.sort()
+
+    for _, name in entries:
+      if self.total_bytes <= target:
+        break
+      logger.debug('Evicting {} from patch cache'.format(name))
+      try:
+        self.path.joinpath(name).unlink()
+      except FileNotFoundError:
+        pass
+      self.total_bytes -= self.sizes.pop(name)
+
+  def take_counters(self):
+    # Returns and resets the (hits, misses) counters
+    with self.lock:
+      ret = (self.hits, self.misses)
+      self.hits = 0
+      self.misses = 0
+    return ret
@@ -1,10 +1,11 @@
+from httpsession import get_http_session
+
 import collections
 import html
 import pathlib
 import json
 import logging
 import re
-import requests
 import sys
 import urllib
 
@@ -109,7 +110,7 @@ class PatchworkSeries(object):
     self.url = url
 
   def get_patch_subjects(self):
-    patch = requests.get(self.url.geturl()).text.replace('\n','')
+    patch = get_http_session().get(self.url.geturl()).text.replace('\n','')
     pattern = '<a'
     pattern += '\s+'
     pattern += 'href='
@@ -134,7 +135,7 @@ class PatchworkPatch(object):
 
     # Handle redirects and update the url member with the result. This allows
     # for better handling of msgid-based urls
-    resp = requests.get(self.url.geturl())
+    resp = get_http_session().get(self.url.geturl())
     resp.raise_for_status()
     if resp.history:
       self.parse_url(resp.url)
@@ -164,7 +165,7 @@ class PatchworkPatch(object):
     self.comments = []
 
   def get_series(self):
-    patch = requests.get(self.url.geturl()).text
+    patch = get_http_session().get(self.url.geturl()).text
     m = re.findall('a href="/series/([0-9]+)/"', patch)
     if not m or not len(m):
       return None
@@ -174,7 +175,7 @@ class PatchworkPatch(object):
     if not self.patch:
       raw_path = pathlib.PurePath(self.url.path, 'raw')
       raw_url = self.url._replace(path=str(raw_path))
-      resp = requests.get(raw_url.geturl())
+      resp = get_http_session().get(raw_url.geturl())
       resp.raise_for_status()
       self.patch = resp.text
     return self.patch
@@ -186,7 +187,7 @@ class PatchworkPatch(object):
     comments_path = pathlib.PurePath(self.path_prefix,
                                      'api/patches/{}/comments/'.format(self.id))
     comments_url = self.url._replace(path=str(comments_path))
-    resp = requests.get(comments_url.geturl())
+    resp = get_http_session().get(comments_url.geturl())
     if resp.status_code != 200:
         return None
 
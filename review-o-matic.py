@@ -38,6 +38,8 @@ def main():
   parser.add_argument('--prefix', default='UPSTREAM', help='subject prefix')
   parser.add_argument('--verbose', help='print commits', action='store_true')
   parser.add_argument('--chatty', help='print diffs', action='store_true')
+  parser.add_argument('--diff-engine', default='myers',
+                      help='engine used to compare patches (myers or differ)')
   args = parser.parse_args()
 
   if args.verbose or args.chatty:
@@ -48,7 +50,8 @@ def main():
 
   regex = re.compile('([0-9a-f]*) (%s): ' % (args.prefix), flags=re.I)
   ret = 0
-  reviewer = Reviewer(args.verbose, args.chatty)
+  reviewer = Reviewer(args.verbose, args.chatty,
+                      diff_engine=args.diff_engine)
   for l in reversed(proc.decode('UTF-8').split('\n')):
     this_ret = 0
     m = regex.match(l)
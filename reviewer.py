@@ -1,9 +1,17 @@
-import difflib
+from diffengine import diff_lines
+from diffengine import get_diff_engine
+from gitbatch import GitBatch
+
+import concurrent.futures
+import email.parser
+import email.policy
 import enum
 import logging
+import multiprocessing
 import re
 import subprocess
 import sys
+import threading
 
 logger = logging.getLogger('rom.reviewer')
 
@@ -21,6 +29,62 @@ class LineType(enum.Enum):
   CONTEXT = ' '
   EMPTY = ''
 
+class LineClassifier(object):
+  '''
+  Classifies diff lines into LineType, returning the same (type, match) tuple as
+  trying each LineType pattern in order. The patterns are compiled once and
+  bucketed by the first character they can match, so a line is only tested
+  against the handful of patterns that could possibly apply to it. Patterns
+  which don't start with a literal (like EMPTY) are tried for every line.
+  '''
+  def __init__(self, types=LineType):
+    self.types = [(t, re.compile(t.value)) for t in types]
+
+    leading = {t: self.__leading_chars(t.value) for t in types}
+    chars = set()
+    for c in leading.values():
+      chars |= c or set()
+
+    self.dispatch = {}
+    for c in chars:
+      self.dispatch[c] = [(t, r) for t, r in self.types
+                          if leading[t] is None or c in leading[t]]
+    self.fallback = [(t, r) for t, r in self.types if leading[t] is None]
+
+  @staticmethod
+  def __leading_chars(pattern):
+    # Returns the set of characters the pattern can start with, or None if it
+    # can't be determined cheaply (in which case the pattern is always tried)
+    if not pattern:
+      return None
+
+    if pattern[0] == '\\' and len(pattern) > 1 and not pattern[1].isalnum():
+      chars, rest = {pattern[1]}, pattern[2:]
+    elif pattern[0] == '[':
+      end = pattern.find(']')
+      cls = pattern[1:end]
+      if (end < 0 or not cls or cls[0] == '^' or '\\' in cls or
+          '-' in cls.strip('-')):
+        return None
+      chars, rest = set(cls), pattern[end + 1:]
+    elif pattern[0] not in '.^$*+?{}()|[]\\':
+      chars, rest = {pattern[0]}, pattern[1:]
+    else:
+      return None
+
+    # An optional first atom means the pattern could start with anything
+    if rest and rest[0] in '*?{':
+      return None
+    return chars
+
+  def classify(self, line):
+    candidates = self.dispatch.get(line[:1], self.fallback)
+    for t, regex in candidates:
+      m = regex.match(line)
+      if m:
+        return (t, m)
+    return None
+
 class CallType(enum.Enum):
   CHECK_OUTPUT = 0
   CHECK_CALL = 1
@@ -149,15 +213,33 @@ class CommitRef(object):
 
 class Reviewer(object):
   MAX_CONTEXT = 5
+  LINE_CLASSIFIER = LineClassifier()
 
-  def __init__(self, verbose=False, chatty=False, git_dir=None):
+  def __init__(self, verbose=False, chatty=False, git_dir=None,
+               diff_engine='myers', diff_workers=0, patch_cache=None,
+               fetch_scheduler=None):
     self.verbose = verbose
     self.chatty = chatty
     self.git_dir = git_dir
+    self.diff_engine = get_diff_engine(diff_engine)
+    self.diff_workers = diff_workers
+    self.diff_pool = None
+    self.patch_cache = patch_cache
+    self.fetch_scheduler = fetch_scheduler
+    # Serializes git operations on the local repo when reviewing concurrently.
+    # Multi-step operations which touch the working tree should hold it too.
+    self.lock = threading.RLock()
     if git_dir:
       self.git_cmd = ['git', '-C', git_dir ]
     else:
       self.git_cmd = ['git']
+    self.git_batch = GitBatch(self.git_cmd)
+
+  def close(self):
+    self.git_batch.close()
+    if self.diff_pool:
+      self.diff_pool.shutdown()
+      self.diff_pool = None
 
   def __strip_commit_msg(self, patch):
     regex = re.compile('diff --git ')
@@ -166,11 +248,7 @@ class Reviewer(object):
         return patch[i:]
 
   def classify_line(self, line):
-    for t in LineType:
-      m = re.match(t.value, line)
-      if m:
-        return (t,m)
-    return None
+    return self.LINE_CLASSIFIER.classify(line)
 
   def __strip_kruft(self, diff, context):
     ret = []
@@ -218,6 +296,10 @@ class Reviewer(object):
 
   def git(self, cmd, call_type, stdout=subprocess.DEVNULL,
           stderr=subprocess.DEVNULL, skip_err=False):
+    with self.lock:
+      return self.__git(cmd, call_type, stdout, stderr, skip_err)
+
+  def __git(self, cmd, call_type, stdout, stderr, skip_err):
     run_cmd = self.git_cmd + cmd
     logger.debug('GIT: {}'.format(' '.join(run_cmd)))
     if call_type == CallType.CHECK_OUTPUT:
@@ -263,6 +345,12 @@ class Reviewer(object):
       logger.error('Failed to add remote {} ({})', str(ref), ret)
 
   def fetch_remote(self, ref):
+    if self.fetch_scheduler:
+      return self.fetch_scheduler.fetch(self, ref)
+    return self.fetch_remote_now(ref)
+
+  def fetch_remote_now(self, ref):
+    # Fetches unconditionally, use fetch_remote() to go through the scheduler
     logger.debug('Fetching {}'.format(str(ref)))
 
     self.add_or_update_remote(ref)
@@ -271,6 +359,7 @@ class Reviewer(object):
     ret = self.git(cmd, CallType.CHECK_CALL, skip_err=True)
     if ret != 0:
       logger.error('Fetch remote ({}) failed: ({})'.format(str(ref), ret))
+    return ret
 
   def checkout(self, ref):
     cmd = ['checkout', ref]
@@ -284,7 +373,28 @@ class Reviewer(object):
 
     self.git(cmd, CallType.CALL)
 
+  def has_object(self, sha):
+    return self.git_batch.has_object(sha)
+
+  def get_commit(self, sha):
+    return self.git_batch.get_commit(sha)
+
+  def get_tree(self, name):
+    return self.git_batch.get_tree(name)
+
+  def get_blob(self, name):
+    return self.git_batch.get_blob(name)
+
+  def resolve(self, name):
+    # Returns the full sha name refers to (ie: 'HEAD~1:some/dir'), or None
+    return self.git_batch.resolve(name)
+
   def get_commit_msg_from_sha(self, sha):
+    commit = self.get_commit(sha)
+    if commit:
+      return commit.message
+
+    # Let git log produce the error for objects cat-file couldn't find
     cmd = ['log', '-1', sha]
     return self.git(cmd, CallType.CHECK_OUTPUT, stderr=None)
 
@@ -310,6 +420,10 @@ class Reviewer(object):
     return ret.splitlines()
 
   def is_sha_in_branch(self, ref, skip_err=False):
+    # No need to ask merge-base about a commit we don't have
+    if not self.has_object(ref.sha):
+      return False
+
     cmd = ['merge-base', '--is-ancestor', ref.sha, ref.refs(True)]
     try:
       ret = self.git(cmd, CallType.CHECK_CALL, skip_err=True)
@@ -321,11 +435,66 @@ class Reviewer(object):
         raise
 
   def get_commit_from_sha(self, ref):
-    cmd = ['show', '--minimal', '-U{}'.format(self.MAX_CONTEXT), r'--format=%B',
-           ref.sha]
+    options = ['--minimal', '-U{}'.format(self.MAX_CONTEXT), r'--format=%B']
+
+    # The cache is keyed on the full object sha, so refs (and abbreviated
+    # shas) are resolved first
+    sha = None
+    if self.patch_cache:
+      sha = self.git_batch.resolve(ref.sha)
+    if sha:
+      ret = self.patch_cache.get(sha, options)
+      if ret is not None:
+        return ret
+
+    cmd = ['show'] + options + [ref.sha]
     ret = self.git(cmd, CallType.CHECK_OUTPUT, stderr=None)
+
+    if sha:
+      self.patch_cache.put(sha, options, ret)
     return ret
 
+  @staticmethod
+  def show_from_format_patch(patch):
+    # Converts `git format-patch` output (like gerrit's /patch endpoint returns)
+    # to the layout of `git show --format=%B`: the raw commit message, two
+    # newlines and the diff. Mail headers, the diffstat and signature are dropped.
+    lines = patch.splitlines()
+    diff_start = None
+    for i, l in enumerate(lines):
+      if l.startswith('diff --git '):
+        diff_start = i
+        break
+    if diff_start is None:
+      raise ValueError('No diff found in patch')
+
+    # Mail headers end at the first blank line, the message at the last '---'
+    # before the diff
+    header_end = lines.index('') if '' in lines[:diff_start] else 0
+    msg_end = diff_start
+    for i in range(diff_start - 1, header_end, -1):
+      if lines[i] == '---':
+        msg_end = i
+        break
+
+    headers = email.parser.HeaderParser(policy=email.policy.default).parsestr(
+                                    '\n'.join(lines[1:header_end]) + '\n\n')
+    subject = re.sub(r'^\[[^\]]*PATCH[^\]]*\]\s*', '',
+                     str(headers.get('Subject', '')))
+
+    body = '\n'.join(lines[header_end + 1:msg_end]).strip('\n')
+    msg = subject + '\n'
+    if body:
+      msg += '\n' + body + '\n'
+
+    diff = lines[diff_start:]
+    while diff and not diff[-1]:
+      diff.pop()
+    # Strip the '-- ' signature (and git version) format-patch adds
+    if len(diff) >= 2 and diff[-2] == '-- ':
+      diff = diff[:-2]
+    return msg + '\n\n' + '\n'.join(diff) + '\n'
+
   def strip_special(self, string):
     return re.sub('([a-z]*\://)|\W', '', string, flags=re.I)
 
@@ -341,7 +510,25 @@ class Reviewer(object):
     cmd = ['update-ref', '-d', ref]
     self.git(cmd, CallType.CHECK_CALL)
 
-  def get_commit_from_remote(self, remote, ref):
+  def fetch_commit(self, remote, ref, sha):
+    # Makes sure sha is in the object store, fetching ref from remote if it
+    # isn't. Only FETCH_HEAD is written, no refs are created or pruned.
+    if self.has_object(sha):
+      return
+
+    cmd = ['fetch', '--no-tags', remote, ref]
+    self.git(cmd, CallType.CHECK_CALL)
+    if not self.has_object(sha):
+      raise ValueError('Fetching {} from {} did not get {}'.format(ref, remote,
+                                                                   sha))
+
+  def get_commit_from_remote(self, remote, ref, sha=None):
+    # If we know which commit ref points to, fetch it straight into the object
+    # store and skip the temporary ref
+    if sha:
+      self.fetch_commit(remote, ref, sha)
+      return self.get_commit_from_sha(CommitRef(sha=sha))
+
     tmp_ref = self.fetch_to_tmp_ref(remote, ref)
 
     ret = self.get_commit_from_sha(CommitRef(sha=tmp_ref))
@@ -349,6 +536,81 @@ class Reviewer(object):
     self.delete_ref(tmp_ref)
     return ret
 
+  def split_files(self, diff):
+    # Split a stripped diff into per-file shards keyed on the file path (the
+    # old path is used for deleted files). A file starts at a '---' line which
+    # is followed by a '+++' line, anything before the first file is keyed ''.
+    files = {}
+    key = ''
+    for i, l in enumerate(diff):
+      l_type,m = self.classify_line(l)
+      if l_type == LineType.FILE_OLD and i + 1 < len(diff):
+        n_type,n = self.classify_line(diff[i + 1])
+        if n_type == LineType.FILE_NEW:
+          key = n.group(1) if n.group(1) != '/dev/null' else m.group(1)
+          # Keep duplicate paths distinct rather than merging them
+          path = key
+          dup = 1
+          while key in files:
+            key = '{}#{}'.format(path, dup)
+            dup += 1
+      files.setdefault(key, []).append(l)
+    return files
+
+  def __get_diff_pool(self):
+    with self.lock:
+      if not self.diff_pool:
+        # Forking copies the state of our other threads' locks (logging, the
+        # cat-file pipes), which can deadlock the children, so workers are
+        # started from a clean forkserver instead
+        self.diff_pool = concurrent.futures.ProcessPoolExecutor(
+                            max_workers=self.diff_workers,
+                            mp_context=multiprocessing.get_context('forkserver'))
+      return self.diff_pool
+
+  def __compare_files(self, a, b):
+    a_files = self.split_files(a)
+    b_files = self.split_files(b)
+
+    # A file which moved (ie: a backport to a tree where it lives elsewhere)
+    # only exists on one side under each path. Pair those up so their hunks are
+    # diffed against each other, first by identical hunks then in order.
+    a_only = [k for k in a_files.keys() if k and k not in b_files]
+    b_only = [k for k in b_files.keys() if k and k not in a_files]
+    hunks = {}
+    for k in b_only:
+      hunks.setdefault(tuple(b_files[k][2:]), []).append(k)
+    moved = {}
+    for k in a_only:
+      match = hunks.get(tuple(a_files[k][2:]))
+      if match:
+        moved[k] = match.pop(0)
+    paired = set(moved.values())
+    moved.update(zip([k for k in a_only if k not in moved],
+                     [k for k in b_only if k not in paired]))
+    paired = set(moved.values())
+
+    # Identical files are skipped outright, only files which differ (or only
+    # exist on one side) get diffed
+    keys = list(a_files.keys())
+    keys += [k for k in b_files.keys() if k not in a_files and k not in paired]
+    pairs = []
+    for k in keys:
+      a_lines = a_files.get(k, [])
+      b_lines = b_files.get(moved.get(k, k), [])
+      if a_lines != b_lines:
+        pairs.append((a_lines, b_lines))
+
+    if self.diff_workers and len(pairs) > 1:
+      pool = self.__get_diff_pool()
+      results = [pool.submit(diff_lines, self.diff_engine, a_lines, b_lines)
+                 for a_lines, b_lines in pairs]
+      for r in results:
+        yield from r.result()
+    else:
+      for a_lines, b_lines in pairs:
+        yield from self.diff_engine.compare(a_lines, b_lines)
+
   def compare_diffs(self, a, b, context=0):
     if context > self.MAX_CONTEXT:
       raise ValueError('Invalid context given')
@@ -366,8 +628,7 @@ class Reviewer(object):
     printed_files = False
 
     ret = []
-    differ = difflib.Differ()
-    for l in differ.compare(a, b):
+    for l in self.__compare_files(a, b):
       # strip the differ margin for analyzing the line
       line = l[2:]
 
@@ -1,19 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
+import concurrent.futures
 import json
 import logging
 import subprocess
 import sys
-import time
 
 from gerrit import Gerrit
+from gerritwatch import ChangeWatcher
+from gerritwatch import GerritEventStream
+from httpsession import configure_http_session
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 class Submitter(object):
   def __init__(self, last_cid, review, verify, ready, abandon, force_review,
-               dry_run):
+               dry_run, workers=1, events=None):
     self.abandon = abandon
     self.vote_review = 2 if review else None
     self.vote_verify = 1 if verify else None
@@ -21,6 +25,7 @@ class Submitter(object):
     self.force_review = force_review
 
     self.dry_run = dry_run
+    self.workers = max(workers, 1)
 
     self.tag = 'autogenerated:submit-o-matic'
 
@@ -30,6 +35,8 @@ class Submitter(object):
     self.changes = []
     self.gerrit = Gerrit('https://chromium-review.googlesource.com',
                          use_internal=False)
+
+    self.watcher = ChangeWatcher(self.gerrit, events=events)
     last_change = self.gerrit.get_change(last_cid)
     ancestor_changes = self.gerrit.get_ancestor_changes(last_change)
     for c in reversed(ancestor_changes):
@@ -49,31 +56,57 @@ class Submitter(object):
   def num_in_flight(self):
     return len(self.in_flight)
 
-  def review_changes(self):
-    if not self.vote_review and not self.vote_verify and not self.abandon:
+  def fetch_changes(self, changes, key):
+    # Refetches changes from gerrit, yielding them in order while keeping up
+    # to self.workers requests in flight. If the caller stops early, changes
+    # which haven't been started yet are not fetched.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers) as pool:
+      pending = collections.deque()
+      try:
+        for c in changes:
+          pending.append(pool.submit(self.gerrit.get_change, key(c)))
+          if len(pending) >= self.workers:
+            yield pending.popleft().result()
+        while pending:
+          yield pending.popleft().result()
+      finally:
+        for f in pending:
+          f.cancel()
+
+  def review_change(self, c):
+    c = self.gerrit.get_change(c.number)
+
+    if self.abandon:
+      if not self.dry_run:
+        self.gerrit.abandon(c)
+      else:
+        print('DRYRUN abandon {}'.format(c))
       return
 
-    for i,c in enumerate(self.changes):
-      sys.stdout.write('\rRunning reviewer (%d/%d)' % (i, self.num_changes()))
-      c = self.gerrit.get_change(c.number)
+    if (c.is_merged() or not self.change_needs_action(c)) and not self.force_review:
+      return
 
-      if self.abandon:
-        if not self.dry_run:
-          self.gerrit.abandon(c)
-        else:
-          print('DRYRUN abandon {}'.format(c))
-        continue
+    if not self.dry_run:
+      self.gerrit.review(c, self.tag, '', False, self.vote_review,
+                        self.vote_verify, None)
+    else:
+      print('DRYRUN review (r={}, v={}) {}'.format(self.vote_review,
+                                                   self.vote_verify,
+                                                   c))
 
-      if (c.is_merged() or not self.change_needs_action(c)) and not self.force_review:
-        continue
+  def review_changes(self):
+    if not self.vote_review and not self.vote_verify and not self.abandon:
+      return
 
-      if not self.dry_run:
-        self.gerrit.review(c, self.tag, '', False, self.vote_review,
-                          self.vote_verify, None)
-      else:
-        print('DRYRUN review (r={}, v={}) {}'.format(self.vote_review,
-                                                     self.vote_verify,
-                                                     c))
+    # Code-Review/Verified votes and abandons don't depend on each other, so
+    # each change is handled independently
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers) as pool:
+      futures = [pool.submit(self.review_change, c) for c in self.changes]
+      for i,f in enumerate(futures):
+        sys.stdout.write('\rRunning reviewer (%d/%d)' % (i, self.num_changes()))
+        f.result()
 
   def submit_changes(self):
     if self.abandon:
@@ -81,12 +114,13 @@ class Submitter(object):
 
     self.in_flight = []
     merged = 0
-    for i,c in enumerate(self.changes):
+    # Changes are fetched concurrently, but votes are cast here in stack
+    # order so the CQ sees a change's parents marked ready before it
+    for i,c in enumerate(self.fetch_changes(self.changes, lambda c: c.id)):
       if self.num_in_flight() >= self.max_in_flight:
         break
 
       sys.stdout.write('\rRunning submitter (%d/%d)' % (i, self.num_changes()))
-      c = self.gerrit.get_change(c.id)
       if c.is_merged():
         merged += 1
         continue
@@ -112,13 +146,12 @@ class Submitter(object):
     if self.num_in_flight() == 0: # everything is merged, so no detection needed
       return True
 
-    c = self.in_flight[0]
-    sys.stdout.write('\rDetecting: %s' % c.url())
-    c = self.gerrit.get_change(c.id)
-    if self.change_needs_action(c):
-      return True
-
-    return False
+    # Blocks until any of the in flight changes is merged or needs a vote
+    sys.stdout.write('\rWatching %d changes' % self.num_in_flight())
+    ready = self.watcher.wait(self.in_flight, self.change_needs_action)
+    for c in ready:
+      sys.stdout.write('\rDetected: %s\n' % c.url())
+    return True
 
 
 def main():
@@ -140,37 +173,52 @@ def main():
   parser.add_argument('--abandon', action='store_true', help='Abandon changes')
   parser.add_argument('--dry-run', action='store_true', help='Practice makes perfect')
   parser.add_argument('--max-tries', default=5, help='Max number to try submit in daemon mode', type=int)
+  parser.add_argument('--workers', default=1, type=int,
+    help='Number of gerrit requests to keep in flight')
+  parser.add_argument('--stream-events-cmd', default=None,
+    help='Command printing gerrit stream-events JSON, used in daemon mode to '
+         'react to changes immediately (ie: "ssh -p 29418 <host> gerrit '
+         'stream-events")')
   args = parser.parse_args()
 
+  # Make sure the connection pool is big enough for the workers
+  configure_http_session(max_per_host=max(args.workers, 4))
+
   ready = None
   if args.ready:
     ready = 2
   elif args.tryjob:
     ready = 1
 
-  s = Submitter(args.last_cid, args.review, args.verify, ready, args.abandon,
-                args.force_review, args.dry_run)
-  s.review_changes()
-  tries = 0
-  while True:
-    s.submit_changes()
-    if s.num_in_flight() == 0:
-      sys.stdout.write('\n\nCongratulations, your changes have landed!\n\n')
-      return True
+  events = None
+  if args.stream_events_cmd:
+    events = GerritEventStream(args.stream_events_cmd)
+    events.start()
+
+  # The event stream's process would outlive us if it weren't stopped
+  try:
+    s = Submitter(args.last_cid, args.review, args.verify, ready, args.abandon,
+                  args.force_review, args.dry_run, args.workers, events)
+    s.review_changes()
+    tries = 0
+    while True:
+      s.submit_changes()
+      if s.num_in_flight() == 0:
+        sys.stdout.write('\n\nCongratulations, your changes have landed!\n\n')
+        return True
 
-    if not args.daemon:
-      break
+      if not args.daemon:
+        break
 
-    if tries >= args.max_tries:
-      sys.stdout.write('\n\nMax tries exceeded!\n\n')
-      return False
-    tries += 1
+      if tries >= args.max_tries:
+        sys.stdout.write('\n\nMax tries exceeded!\n\n')
+        return False
+      tries += 1
 
-    while True:
-      sys.stdout.write('\rSleeping...                                        ')
-      if s.detect_change():
-        break
-      time.sleep(60)
+      s.detect_change()
+  finally:
+    if events:
+      events.stop()
 
 if __name__ == '__main__':
   sys.exit(main())
@@ -2,9 +2,14 @@
 
 from exceptions import GerritFetchError
 from gerrit import Gerrit, GerritRevision, GerritMessage
+from fetchscheduler import FetchScheduler
+from httpsession import get_http_session
+from patchcache import PatchCache
 from reviewer import Reviewer
 
 from trollconfig import TrollConfig
+from trollledger import TrollLedger
+from trollpoll import TrollPollCursor
 from trollreview import ReviewType
 from trollreviewer import ChangeReviewer
 from trollreviewerfromgit import FromgitChangeReviewer
@@ -12,15 +17,20 @@ from trollreviewerupstream import UpstreamChangeReviewer
 from trollreviewerfromlist import FromlistChangeReviewer
 from trollreviewerchromium import ChromiumChangeReviewer
 from trollstats import TrollStats
+from worktreepool import WorktreePool
 
 import argparse
+import concurrent.futures
 import datetime
 import json
 import logging
 from logging import handlers
+import pathlib
+import queue
 import re
 import requests
 import sys
+import threading
 import time
 
 logger = logging.getLogger('rom')
@@ -33,9 +43,34 @@ class Troll(object):
     self.config = config
     self.gerrit = Gerrit(config.gerrit_url, netrc=config.netrc)
     self.gerrit_admin = Gerrit(config.gerrit_url, netrc=config.netrc_admin)
+    self.gerrit.page_size = config.gerrit_page_size
     self.tag = 'autogenerated:review-o-matic'
-    self.ignore_list = {}
+    # In dry-run mode nothing is posted, so don't persist anything either
+    self.ledger = TrollLedger(None if config.dry_run else config.ledger_file,
+                              config.ledger_expiry_days)
+    self.poll_cursors = {}
     self.stats = TrollStats('{}'.format(self.config.stats_file))
+    self.patch_cache = None
+    if self.config.patch_cache_dir:
+      self.patch_cache = PatchCache(self.config.patch_cache_dir,
+                                    self.config.patch_cache_size)
+    self.config_cache = None
+    if self.config.kconfig_cache_dir:
+      self.config_cache = PatchCache(self.config.kconfig_cache_dir,
+                                     self.config.kconfig_cache_size)
+    # Kernel configs are generated in worktrees so they don't need the local
+    # repo to themselves, one per concurrent review plus a spare so both sides
+    # of a CL can be generated at once
+    self.worktree_pools = {}
+    if self.config.kconfig_worktree_dir:
+      for p in self.config.projects.values():
+        if not p.review_kconfig:
+          continue
+        self.worktree_pools[p.name] = WorktreePool(p.local_repo,
+                pathlib.Path(self.config.kconfig_worktree_dir).joinpath(p.name),
+                max(1, self.config.workers) + 1)
+    # Shared by every project's Reviewer so fetches coalesce across runs
+    self.fetch_scheduler = FetchScheduler(self.config.fetch_freshness)
 
   def do_review(self, project, change, review):
     logger.info('Review for change: {}'.format(change.url()))
@@ -69,21 +104,66 @@ class Troll(object):
           change.url(), review.issues.keys(), review.feedback.keys(),
           review.vote, review.notify))
 
-  def get_changes(self, project, prefix):
-    message = '{}:'.format(prefix)
-    after = datetime.date.today() - datetime.timedelta(days=5)
-    changes = self.gerrit.query_changes(status='open', message=message,
+  def get_poll_cursor(self, project):
+    if not self.poll_cursors.get(project.name):
+      self.poll_cursors[project.name] = TrollPollCursor(
+              datetime.timedelta(days=5),
+              datetime.timedelta(minutes=self.config.poll_resync_minutes))
+    return self.poll_cursors[project.name]
+
+  def get_changes(self, project):
+    # Query all prefixes at once, a change matching more than one prefix (ie:
+    # BACKPORT: FROMGIT:) is only returned once this way
+    messages = ['{}:'.format(p) for p in project.prefixes]
+    after = self.get_poll_cursor(project).next_after()
+    changes = {}
+    # Only fetch change summaries here, the messages and votes are fetched by
+    # get_change_details for the changes which actually need a look
+    for c in self.gerrit.query_changes(status='open', message=messages,
                     after=after, project=project.gerrit_project,
-                    branches=project.monitor_branches)
-    return changes
+                    branches=project.monitor_branches,
+                    options=self.gerrit.summary_options):
+      changes[(c.number, c.current_revision.number)] = c
+    return list(changes.values())
+
+  def needs_details(self, change):
+    # Retry requests and forced reviews are handled by process_change, anything
+    # else whose current revision is in the ledger has already been dealt with
+    if self.config.force_cl or self.config.force_all:
+      return True
+    if change.topic and self.RETRY_REVIEW_KEY in change.topic.split():
+      return True
+    return not self.is_change_in_ignore_list(change)
+
+  def get_change_details(self, changes):
+    # Replaces summary changes with fully detailed ones, in one batched query
+    needed = [c.number for c in changes if not c.detailed]
+    detailed = self.gerrit.get_changes(needed) if needed else {}
+
+    ret = []
+    for c in changes:
+      if c.detailed:
+        ret.append(c)
+      elif c.number in detailed:
+        ret.append(detailed[c.number])
+      else:
+        logger.error('Could not fetch details for change {}'.format(c.url()))
+    return ret
 
-  def add_change_to_ignore_list(self, change):
-    self.ignore_list[change.number] = change.current_revision.number
+  def update_poll_cursor(self, project, changes):
+    # Changes which weren't added to the ignore list failed in a way that we
+    # want to retry, make sure the next poll picks them up again
+    pending = [c for c in changes if not self.is_change_in_ignore_list(c)]
+    self.get_poll_cursor(project).update(changes, pending)
+
+  def add_change_to_ignore_list(self, change, reviewer=None, outcome=None):
+    self.ledger.record(change, reviewer, outcome)
 
   def is_change_in_ignore_list(self, change):
-    return self.ignore_list.get(change.number) == change.current_revision.number
+    return self.ledger.contains(change)
 
-  def process_change(self, project, rev, c):
+  def prepare_change(self, project, rev, c):
+    # Returns the reviewer for the change, and whether it should review it
     if self.config.chatty:
       logger.debug('Processing change {}'.format(c.url()))
 
@@ -135,6 +215,8 @@ class Troll(object):
                                         self.config.gerrit_msg_limit,
                                         self.config.dry_run,
                                         self.config.verbose)
+      reviewer.worktrees = self.worktree_pools.get(project.name)
+      reviewer.config_cache = self.config_cache
 
     # Clear the retry request from the topic
     if retry_request:
@@ -142,47 +224,158 @@ class Troll(object):
       c.topic = ' '.join(topic_list)
       if not self.gerrit_admin.set_topic(c):
         logger.error('ERROR: Failed to clear retry request from change')
-        return None
+        return (reviewer, False)
 
     if not reviewer:
-      self.add_change_to_ignore_list(c)
-      return None
+      return (None, False)
+    reviewer.gerrit = self.gerrit
 
     if not force_review and self.is_change_in_ignore_list(c):
-      return None
+      return (reviewer, False)
+
+    return (reviewer, True)
+
+  def process_change(self, project, rev, c):
+    reviewer, review = self.prepare_change(project, rev, c)
+    if not review:
+      return (reviewer, None)
+    return (reviewer, reviewer.review_patch())
+
+  def prefetch_changes(self, project, rev, changes, prefetched, stop, timing):
+    # Fetch stage of the pipeline, see process_changes_pipelined
+    for c in changes:
+      start = time.monotonic()
+      reviewer, review, error = None, False, None
+      try:
+        reviewer, review = self.prepare_change(project, rev, c)
+        if review:
+          reviewer.prefetch_patches()
+      except Exception as e:
+        error = e
+      timing['fetch'] += time.monotonic() - start
+
+      while not stop.is_set():
+        try:
+          prefetched.put((c, reviewer, review, error), timeout=1)
+          break
+        except queue.Full:
+          continue
+      if stop.is_set():
+        return
+
+  def process_changes_pipelined(self, project, rev, changes):
+    # Fetching patches is mostly waiting on the network, and comparing them is
+    # mostly CPU, so fetch up to PrefetchDepth changes ahead in a thread while
+    # this one reviews. Reviews are posted in order from this thread.
+    prefetched = queue.Queue(maxsize=self.config.prefetch_depth)
+    stop = threading.Event()
+    timing = {'fetch': 0.0, 'wait': 0.0, 'review': 0.0}
+    fetcher = threading.Thread(target=self.prefetch_changes, daemon=True,
+                               args=(project, rev, changes, prefetched, stop,
+                                     timing))
+    fetcher.start()
 
-    return reviewer.review_patch()
+    ret = 0
+    try:
+      for _ in changes:
+        start = time.monotonic()
+        c, reviewer, review, error = prefetched.get()
+        timing['wait'] += time.monotonic() - start
+
+        def get_result():
+          if error:
+            raise error
+          if not review:
+            return (reviewer, None)
+          return (reviewer, reviewer.review_patch())
+
+        start = time.monotonic()
+        ret += self.finish_change(project, c, get_result)
+        timing['review'] += time.monotonic() - start
+    finally:
+      stop.set()
+      fetcher.join()
+
+    logger.debug('{} pipeline: fetch={:.1f}s review={:.1f}s waiting={:.1f}s'
+                 .format(project.name, timing['fetch'], timing['review'],
+                         timing['wait']))
+    return ret
+
+  def is_branch_ignored(self, project, change):
+    for b in project.ignore_branches:
+      if re.match(b, change.branch):
+        return True
+    return False
+
+  def finish_change(self, project, c, get_result):
+    try:
+      reviewer, result = get_result()
+      name = type(reviewer).__name__ if reviewer else None
+      if result:
+        self.do_review(project, c, result)
+        self.add_change_to_ignore_list(c, name, 'reviewed')
+        return 1
+      # Don't clobber the ledger entry of a change we've already handled
+      if not self.is_change_in_ignore_list(c):
+        self.add_change_to_ignore_list(c, name,
+                                       'no_feedback' if name else 'no_reviewer')
+    except GerritFetchError as e:
+      logger.error('Gerrit fetch failed, will retry, {}'.format(c.url()))
+      logger.exception('Exception: {}'.format(e))
+      # Don't add change to ignore list, we want to retry next time
+    except Exception as e:
+      logger.error('Exception processing change {}'.format(c.url()))
+      logger.exception('Exception: {}'.format(e))
+      self.add_change_to_ignore_list(c, outcome='error')
+    return 0
 
   def process_changes(self, project, changes):
     rev = Reviewer(git_dir=project.local_repo, verbose=self.config.verbose,
-                   chatty=self.config.chatty)
-    ret = 0
+                   chatty=self.config.chatty,
+                   diff_engine=self.config.diff_engine,
+                   diff_workers=self.config.diff_workers,
+                   patch_cache=self.patch_cache,
+                   fetch_scheduler=self.fetch_scheduler)
+
+    to_process = []
     for c in changes:
-      ignore = False
-      for b in project.ignore_branches:
-        if re.match(b, c.branch):
-          ignore = True
-          break
-      if ignore:
+      if self.is_branch_ignored(project, c):
         if self.config.chatty:
           logger.debug('Ignoring change {}'.format(c))
-        self.add_change_to_ignore_list(c)
+        self.add_change_to_ignore_list(c, outcome='ignored_branch')
+        continue
+      if not self.needs_details(c):
         continue
+      to_process.append(c)
 
-      try:
-        result = self.process_change(project, rev, c)
-        if result:
-          self.do_review(project, c, result)
-          ret += 1
-        self.add_change_to_ignore_list(c)
-      except GerritFetchError as e:
-        logger.error('Gerrit fetch failed, will retry, {}'.format(c.url()))
-        logger.exception('Exception: {}'.format(e))
-        # Don't add change to ignore list, we want to retry next time
-      except Exception as e:
-        logger.error('Exception processing change {}'.format(c.url()))
-        logger.exception('Exception: {}'.format(e))
-        self.add_change_to_ignore_list(c)
+    if self.config.chatty:
+      logger.debug('{} of {} changes need review'.format(len(to_process),
+                                                        len(changes)))
+    to_process = self.get_change_details(to_process)
+
+    ret = 0
+    try:
+      if self.config.workers > 1 and len(to_process) > 1:
+        # Reviews are computed concurrently, but posted (and the ignore list
+        # and stats updated) in order from this thread, just like serial mode.
+        # The Reviewer serializes git operations on the local repo.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.config.workers) as pool:
+          futures = [pool.submit(self.process_change, project, rev, c)
+                     for c in to_process]
+          for c, f in zip(to_process, futures):
+            ret += self.finish_change(project, c, f.result)
+      elif self.config.prefetch_depth > 0 and len(to_process) > 1:
+        ret += self.process_changes_pipelined(project, rev, to_process)
+      else:
+        for c in to_process:
+          ret += self.finish_change(project, c,
+                    lambda: self.process_change(project, rev, c))
+    finally:
+      rev.close()
+
+    if self.patch_cache:
+      self.stats.update_for_patch_cache(project, self.patch_cache)
 
     return ret
 
@@ -199,20 +392,24 @@ class Troll(object):
     while True:
       try:
         did_review = 0
+        self.ledger.expire()
         for project in self.config.projects.values():
           if (self.config.force_project and
               project.name != self.config.force_project):
             continue
           if self.config.chatty:
             logger.debug('Running for project {}'.format(project.name))
-          for p in project.prefixes:
-            changes = self.get_changes(project, p)
-            if self.config.chatty:
-              logger.debug('{} changes for prefix {}'.format(len(changes), p))
-            did_review += self.process_changes(project, changes)
+          changes = self.get_changes(project)
+          if self.config.chatty:
+            logger.debug('{} changes for prefixes {}'.format(len(changes),
+                                                project.prefixes))
+          did_review += self.process_changes(project, changes)
+          self.update_poll_cursor(project, changes)
 
         if did_review > 0:
           self.stats.summarize(logging.INFO)
+          get_http_session().summarize(logging.INFO)
+          self.fetch_scheduler.summarize(logging.INFO)
           if not self.config.dry_run:
             self.stats.save()
 
@@ -1,3 +1,5 @@
+from configchecker import KernelConfigChecker
+
 import argparse
 import collections
 import configparser
@@ -21,6 +23,8 @@ TrollConfigProject = collections.namedtuple('TrollConfigProject',
                                               'monitor_branches',
                                               'ignore_branches',
                                               'ignore_sob',
+                                              'gerrit_patch_source',
+                                              'kconfig_generator',
                                             ])
 
 TrollConfigPatchwork = collections.namedtuple('TrollConfigPatchwork',
@@ -41,6 +45,7 @@ class TrollConfig(object):
       config_file = self.config_file
     else:
       self.force_prefix = None
+      self.workers = 1
 
     self.config = configparser.ConfigParser()
     self.config.read(config_file)
@@ -53,9 +58,36 @@ class TrollConfig(object):
     self.netrc_admin = self.config.get('global', 'NetRCAdmin', fallback=None)
     self.gerrit_url = self.config.get('global', 'GerritUrl')
     self.gerrit_msg_limit = self.config.getint('global', 'GerritMsgLimit')
+    self.gerrit_page_size = self.config.getint('global', 'GerritPageSize',
+                                               fallback=100)
     self.stats_file = self.config.get('global', 'StatsFile', fallback=None)
     self.results_file = self.config.get('global', 'ResultsFile', fallback=None)
     self.log_file = self.config.get('global', 'LogFile', fallback=None)
+    self.ledger_file = self.config.get('global', 'LedgerFile', fallback=None)
+    self.ledger_expiry_days = self.config.getint('global', 'LedgerExpiryDays',
+                                                 fallback=14)
+    self.diff_engine = self.config.get('global', 'DiffEngine',
+                                       fallback='myers')
+    self.diff_workers = self.config.getint('global', 'DiffWorkers', fallback=0)
+    self.poll_resync_minutes = self.config.getint('global',
+                                                  'PollResyncMinutes',
+                                                  fallback=60)
+    self.patch_cache_dir = self.config.get('global', 'PatchCacheDir',
+                                           fallback=None)
+    self.patch_cache_size = self.config.getint('global', 'PatchCacheSizeMB',
+                                               fallback=256) * 1024 * 1024
+    self.kconfig_worktree_dir = self.config.get('global', 'KconfigWorktreeDir',
+                                                fallback=None)
+    self.kconfig_cache_dir = self.config.get('global', 'KconfigCacheDir',
+                                             fallback=None)
+    self.kconfig_cache_size = self.config.getint('global',
+                                                 'KconfigCacheSizeMB',
+                                                 fallback=64) * 1024 * 1024
+    self.prefetch_depth = self.config.getint('global', 'PrefetchDepth',
+                                             fallback=2)
+    self.fetch_freshness = self.config.getint('global',
+                                              'FetchFreshnessSeconds',
+                                              fallback=300)
     self.project_names = self.config.get('global', 'Projects').split(',')
 
   def parse_projects(self):
@@ -94,6 +126,18 @@ class TrollConfig(object):
       ignore_branches.append(self.config.get('ignorebranch_{}'.format(b),
                                             'Regex'))
 
+    gerrit_patch_source = self.config.get(sec, 'GerritPatchSource',
+                                          fallback='git')
+    if gerrit_patch_source not in ('git', 'rest', 'both'):
+      raise ValueError('Invalid GerritPatchSource {} for {}'.format(
+                       gerrit_patch_source, sec))
+
+    kconfig_generator = self.config.get(sec, 'KconfigGenerator',
+                                        fallback='script')
+    if kconfig_generator not in KernelConfigChecker.GENERATORS:
+      raise ValueError('Invalid KconfigGenerator {} for {}'.format(
+                       kconfig_generator, sec))
+
     return TrollConfigProject(self.config.get(sec, 'Name'),
                               self.config.get(sec, 'GerritProject'),
                               self.config.get(sec, 'MainlineLocation'),
@@ -105,7 +149,8 @@ class TrollConfig(object):
                               prefixes, patchworks, blocked_repos,
                               monitor_branches, ignore_branches,
                               self.config.getboolean(sec, 'IgnoreSignedOffBy',
-                                                     fallback=False))
+                                                     fallback=False),
+                              gerrit_patch_source, kconfig_generator)
 
   def build_patchwork(self, sec):
     return TrollConfigPatchwork(self.config.get(sec, 'Name'),
@@ -132,6 +177,8 @@ class TrollConfig(object):
     parser.add_argument('--force-project', default=None,
                         help='Only search for changes in the provided project')
     parser.add_argument('--config', default=None, help='Path to config file')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of changes to review concurrently')
 
     args = parser.parse_args()
     self.verbose = args.verbose
@@ -144,6 +191,7 @@ class TrollConfig(object):
     self.force_prefix = args.force_prefix
     self.force_project = args.force_project
     self.config_file = args.config
+    self.workers = args.workers
 
   def get_project(self, project):
     for p in self.projects.values():
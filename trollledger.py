@@ -0,0 +1,58 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('rom.troll.ledger')
+
+class TrollLedger(object):
+  '''
+  Persistent record of the last revision of each change the troll has dealt
+  with, along with the reviewer that handled it, the outcome and when. Backed
+  by sqlite so it survives restarts and lookups are a primary key hit. Entries
+  older than expiry_days are dropped by expire().
+  '''
+  def __init__(self, path=None, expiry_days=14):
+    self.path = path or ':memory:'
+    self.expiry_secs = expiry_days * 24 * 60 * 60
+    self.lock = threading.Lock()
+
+    logger.debug('Opening review ledger {}'.format(self.path))
+    self.db = sqlite3.connect(self.path, check_same_thread=False)
+    self.db.execute('''CREATE TABLE IF NOT EXISTS reviews (
+                         change INTEGER PRIMARY KEY,
+                         revision INTEGER NOT NULL,
+                         reviewer TEXT,
+                         outcome TEXT,
+                         timestamp REAL NOT NULL)''')
+    self.db.commit()
+
+  def record(self, change, reviewer, outcome):
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO reviews VALUES (?, ?, ?, ?, ?)',
+                      (change.number, change.current_revision.number, reviewer,
+                       outcome, time.time()))
+      self.db.commit()
+
+  def get(self, number):
+    # Returns (revision, reviewer, outcome, timestamp) for a change number
+    with self.lock:
+      return self.db.execute('SELECT revision, reviewer, outcome, timestamp '
+                             'FROM reviews WHERE change = ?',
+                             (number,)).fetchone()
+
+  def contains(self, change):
+    entry = self.get(change.number)
+    return entry is not None and entry[0] == change.current_revision.number
+
+  def expire(self):
+    with self.lock:
+      cur = self.db.execute('DELETE FROM reviews WHERE timestamp < ?',
+                            (time.time() - self.expiry_secs,))
+      self.db.commit()
+    if cur.rowcount:
+      logger.debug('Expired {} ledger entries'.format(cur.rowcount))
+
+  def close(self):
+    with self.lock:
+      self.db.close()
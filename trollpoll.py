@@ -0,0 +1,47 @@
+import datetime
+import logging
+
+logger = logging.getLogger('rom.troll.poll')
+
+class TrollPollCursor(object):
+  '''
+  Tracks the high-water mark of `last_updated` for a project's query so that
+  subsequent polls only ask for changes updated since then. A full query over
+  the whole window is issued on the first poll and every resync_interval
+  thereafter to pick up anything the incremental polls missed.
+  '''
+  # Re-query a little before the mark to cover replication lag and changes
+  # sharing a timestamp with the mark
+  OVERLAP = datetime.timedelta(minutes=2)
+
+  def __init__(self, window, resync_interval):
+    self.window = window
+    self.resync_interval = resync_interval
+    self.mark = None
+    self.last_resync = None
+    self.after = None
+
+  def next_after(self):
+    now = datetime.datetime.utcnow()
+    if (self.mark is None or self.last_resync is None or
+        now - self.last_resync >= self.resync_interval):
+      logger.debug('Full resync, polling the last {}'.format(self.window))
+      self.last_resync = now
+      self.after = now - self.window
+    else:
+      self.after = self.mark - self.OVERLAP
+    return self.after
+
+  def update(self, changes, pending=None):
+    # Nothing older than the last query can have been missed
+    mark = self.after
+    for c in changes:
+      if mark is None or c.last_updated > mark:
+        mark = c.last_updated
+
+    # Changes which still need processing must be returned by the next poll,
+    # so don't let the mark move past them
+    if pending:
+      self.mark = min([mark] + [c.last_updated for c in pending])
+    elif self.mark is None or mark > self.mark:
+      self.mark = mark
@@ -17,7 +17,12 @@ class ChangeReviewer(object):
     self.msg_limit = msg_limit
     self.dry_run = dry_run
     self.gerrit_patch = None
+    # 'git' or 'rest', depending on where gerrit_patch came from
+    self.gerrit_patch_source = None
+    # Set by the caller to download patches over REST (see GerritPatchSource)
+    self.gerrit = None
     self.upstream_patch = None
+    self.patches_fetched = False
     self.review_result = None
     self.strings = None
     self.diff = None
@@ -74,16 +79,26 @@ class ChangeReviewer(object):
     self.review_result.add_review(ReviewType.MISSING_FIELDS, msg, vote=-1,
                                   notify=True)
 
-  def get_gerrit_patch(self):
-
-    if self.gerrit_patch:
-      return
+  def get_gerrit_patch_rest(self):
+    for i in range(0, 4):
+      try:
+        patch = self.gerrit.get_patch(self.change)
+        self.gerrit_patch = self.reviewer.show_from_format_patch(patch)
+        self.gerrit_patch_source = 'rest'
+        return True
+      except Exception as e:
+        logger.error(f'ERROR: Failed to download patch: ({e})')
+        continue
+    return False
 
+  def get_gerrit_patch_git(self):
     for i in range(0, 4):
       try:
         self.gerrit_patch = self.reviewer.get_commit_from_remote(
                                   self.project.gerrit_remote_name,
-                                  self.change.current_revision.ref)
+                                  self.change.current_revision.ref,
+                                  self.change.current_revision.id)
+        self.gerrit_patch_source = 'git'
         return True
       except BaseException as e:
         logger.error(f'ERROR: Failed to get commit from remote: ({e})')
@@ -91,6 +106,21 @@ class ChangeReviewer(object):
     raise GerritFetchError('ERROR: Could not get gerrit patch {}\n'.format(
                             self.change))
 
+  def get_gerrit_patch(self):
+
+    if self.gerrit_patch:
+      return
+
+    source = self.project.gerrit_patch_source
+    if source in ('rest', 'both') and self.gerrit:
+      if self.get_gerrit_patch_rest():
+        return True
+      if source == 'rest':
+        raise GerritFetchError('ERROR: Could not download gerrit patch {}\n'.
+                               format(self.change))
+
+    return self.get_gerrit_patch_git()
+
   def get_upstream_patch(self):
     raise NotImplementedError()
 
@@ -101,6 +131,11 @@ class ChangeReviewer(object):
     self.get_gerrit_patch()
     self.get_upstream_patch()
 
+  def prefetch_patches(self):
+    # Fetch the patches ahead of review_patch, which won't fetch them again
+    self.get_patches()
+    self.patches_fetched = True
+
   def validate_commit_message(self):
     cur_rev = self.change.current_revision
     fields={'sob':False, 'bug':False, 'test':False}
@@ -129,6 +164,15 @@ class ChangeReviewer(object):
     self.diff = self.reviewer.compare_diffs(self.upstream_patch,
                                             self.gerrit_patch, context=context)
 
+    # Patches from REST only have 3 lines of context and use gerrit's diff
+    # algorithm, so differences are confirmed against the git patch
+    if self.gerrit_patch_source == 'rest' and (context or self.diff):
+      logger.debug('Confirming diff of {} with git'.format(self.change.url()))
+      self.get_gerrit_patch_git()
+      self.diff = self.reviewer.compare_diffs(self.upstream_patch,
+                                              self.gerrit_patch,
+                                              context=context)
+
   def compare_patches_clean(self):
     raise NotImplementedError()
 
@@ -149,7 +193,8 @@ class ChangeReviewer(object):
   def review_patch(self):
     logger.debug('{} handling change {}'.format(type(self).__name__,
                                                 self.change.url()))
-    self.get_patches()
+    if not self.patches_fetched:
+      self.get_patches()
     self.validate_commit_message()
     if self.gerrit_patch and self.upstream_patch:
       self.diff_patches()
@@ -19,6 +19,10 @@ class ChromiumChangeReviewer(ChangeReviewer):
     self.review_backports = False
     self.verbose = verbose
     self.config_diff = None
+    # Set by the caller to generate configs in worktrees (see WorktreePool)
+    self.worktrees = None
+    # Set by the caller to cache baseline configs (see KernelConfigChecker)
+    self.config_cache = None
 
   @staticmethod
   def can_review_change(project, change, days_since_last_review):
@@ -30,12 +34,16 @@ class ChromiumChangeReviewer(ChangeReviewer):
   def get_gerrit_patch(self):
     super().get_gerrit_patch()
     kconfigchecker = KernelConfigChecker(reviewer=self.reviewer,
-                                         verbose=self.verbose)
+                                         verbose=self.verbose,
+                                         worktrees=self.worktrees,
+                                         config_cache=self.config_cache,
+                                         generator=self.project.kconfig_generator)
 
     if kconfigchecker.is_config_change(self.gerrit_patch):
       self.config_diff = kconfigchecker.get_kernel_configs(
                                       self.project.gerrit_remote_name,
-                                      self.change.current_revision.ref)
+                                      self.change.current_revision.ref,
+                                      self.change.current_revision.id)
 
     if self.config_diff:
       self.add_config_change_review()
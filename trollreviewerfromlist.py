@@ -6,6 +6,7 @@ from trollreviewer import ChangeReviewer
 from trollstrings import ReviewStrings
 
 from fuzzywuzzy import fuzz
+import bisect
 import logging
 import sys
 
@@ -31,6 +32,62 @@ below.
   UPSTREAM_COMMENT_LINE='''
   From {} <{}>: {}'''
 
+class PatchLineIndex(object):
+  '''
+  Index of a gerrit patch for placing inline comments. Each line is classified
+  once, recording the gerrit file and line number it corresponds to, and the
+  positions of each (normalized) line's text are kept so finding the next
+  occurrence of a line is a lookup rather than a walk through the patch.
+  '''
+  def __init__(self, reviewer, diff):
+    self.positions = []
+    self.lines = {}
+
+    cur_file = '/COMMIT_MSG'
+    cur_line = 6 # The COMMIT_MSG "file" has a 6 line header
+    for i, l in enumerate(diff):
+      t,m = reviewer.classify_line(l)
+      # If a file is being deleted, the file below will be /dev/null. Gerrit
+      # (rightfully) doesn't know what to do with a comment on the file
+      # /dev/null, so it will throw a 400-BAD_REQUEST if we try.
+      #
+      # TODO: We should store FILE_OLD as cur_file and then update cur_file to
+      #       FILE_NEW if it is not /dev/null. I _think_ it's that easy, but
+      #       don't have time to actually test the edge cases. So for now we'll
+      #       store /dev/null and then discard the comment because
+      #       msg.has_filename() will fail. All this work for nothing :(
+      if t == LineType.FILE_NEW:
+        cur_file = m.group(1)
+        cur_line = 0
+      elif t == LineType.CHUNK:
+        cur_line = int(m.group(3)) - 1 # Take away one since we add it back
+
+      # Increment the line count if we're counting up from a chunk or parsing
+      # the commit message
+      elif (t == LineType.CONTEXT or
+            (t == LineType.DIFF and l[0] == '+') or
+            cur_file == '/COMMIT_MSG'):
+        cur_line += 1
+
+      self.positions.append((cur_file, cur_line))
+      self.lines.setdefault(l.strip('+- \t'), []).append(i)
+
+  def find(self, text, start):
+    # Returns the first position at or after start of a line matching text
+    # (already normalized), or None
+    positions = self.lines.get(text)
+    if not positions:
+      return None
+    i = bisect.bisect_left(positions, start)
+    if i == len(positions):
+      return None
+    return positions[i]
+
+  def get_position(self, pos):
+    # Returns the (file, line) gerrit knows the line at pos as
+    return self.positions[pos]
+
+
 class FromlistChangeReviewer(ChangeReviewer):
   def __init__(self, project, reviewer, change, msg_limit, dry_run):
     super().__init__(project, reviewer, change, msg_limit, dry_run)
@@ -125,54 +182,20 @@ class FromlistChangeReviewer(ChangeReviewer):
     else:
       self.add_clear_votes_review()
 
-  def find_line_for_inline_msg(self, diff, msg):
-    cur_file = '/COMMIT_MSG'
-    cur_line = 6 # The COMMIT_MSG "file" has a 6 line header
-    ctx_counter = 0
-
-    for l in diff:
-      t,m = self.reviewer.classify_line(l)
-      # If a file is being deleted, the file below will be /dev/null. Gerrit
-      # (rightfully) doesn't know what to do with a comment on the file
-      # /dev/null, so it will throw a 400-BAD_REQUEST if we try.
-      #
-      # TODO: We should store FILE_OLD as cur_file and then update cur_file to
-      #       FILE_NEW if it is not /dev/null. I _think_ it's that easy, but
-      #       don't have time to actually test the edge cases. So for now we'll
-      #       store /dev/null and then discard the comment because
-      #       msg.has_filename() will fail. All this work for nothing :(
-      if t == LineType.FILE_NEW:
-        cur_file = m.group(1)
-        cur_line = 0
-      elif t == LineType.CHUNK:
-        cur_line = int(m.group(3)) - 1 # Take away one since we add it back
-
-      # Increment the line count if we're counting up from a chunk or parsing
-      # the commit message
-      elif (t == LineType.CONTEXT or
-            (t == LineType.DIFF and l[0] == '+') or
-            cur_file == '/COMMIT_MSG'):
-        cur_line += 1
-
-      ratio = fuzz.token_set_ratio(l, msg.context[ctx_counter])
-      gerrit_line = l.strip('+- \t')
-      context_line = msg.context[ctx_counter].strip('+- \t')
-
-      #logging.debug('G: {}'.format(l.strip('+- \t')))
-      #logging.debug('P: {}'.format(msg.context[ctx_counter].strip('+- \t')))
-
-      if gerrit_line == context_line:
-        # If we find any (non-empty) match, set the return values since the
-        # context may not _exactly_ match
-        if context_line:
-          msg.set_filename(cur_file)
-          msg.set_line(cur_line)
-        ctx_counter += 1
-
-      #logging.debug('R: f={} l={} cc={} ratio={}'.format(msg.filename, msg.line, ctx_counter, ratio))
-
-      if ctx_counter and ctx_counter == len(msg.context):
+  def find_line_for_inline_msg(self, index, msg):
+    # Match the comment's context lines, in order, against the patch. The last
+    # (non-empty) line matched is where the comment goes, since the context may
+    # not _exactly_ match.
+    pos = -1
+    for ctx in msg.context:
+      context_line = ctx.strip('+- \t')
+      pos = index.find(context_line, pos + 1)
+      if pos is None:
         break
+      if context_line:
+        filename, line = index.get_position(pos)
+        msg.set_filename(filename)
+        msg.set_line(line)
 
   def find_parent_comment(self, msg):
     msg_test = ' '.join(msg.context).lower()
@@ -196,10 +219,10 @@ class FromlistChangeReviewer(ChangeReviewer):
     if not self.patchwork_comments:
       return
 
-    split_patch = self.gerrit_patch.split('\n')
+    index = PatchLineIndex(self.reviewer, self.gerrit_patch.split('\n'))
     for c in self.patchwork_comments:
       for m in c.inline_comments:
-        self.find_line_for_inline_msg(split_patch, m)
+        self.find_line_for_inline_msg(index, m)
 
     for c in self.patchwork_comments:
       for m in c.inline_comments:
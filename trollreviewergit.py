@@ -1,10 +1,10 @@
+from httpsession import get_http_session
 from reviewer import CommitRef
 from trollreview import ReviewType
 from trollreviewer import ChangeReviewer
 
 import logging
 import re
-import requests
 import sys
 import urllib
 
@@ -69,7 +69,7 @@ class GitChangeReviewer(ChangeReviewer):
       logger.warning('Could not parse web link for {}'.format(remote))
       return
 
-    r = requests.get(l)
+    r = get_http_session().get(l)
     if r.status_code == 200:
       self.review_result.add_web_link(l)
     else:
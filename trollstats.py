@@ -3,6 +3,7 @@ from trollreview import ReviewType
 import collections
 import json
 import logging
+import threading
 
 logger = logging.getLogger('rom.troll.stats')
 
@@ -10,6 +11,7 @@ class TrollStats(object):
   def __init__(self, filepath):
     self.stats = collections.defaultdict(dict)
     self.filepath = filepath
+    self.lock = threading.Lock()
 
     if self.filepath:
       try:
@@ -33,15 +35,23 @@ class TrollStats(object):
     for f in review.feedback:
       self.increment(project, f)
 
-  def increment(self, project, review_type):
+  def update_for_patch_cache(self, project, patch_cache):
+    hits, misses = patch_cache.take_counters()
+    if hits:
+      self.increment(project, 'patch_cache_hits', hits)
+    if misses:
+      self.increment(project, 'patch_cache_misses', misses)
+
+  def increment(self, project, review_type, count=1):
     pkey = project.name
     rkey = str(review_type)
-    if not self.stats.get(pkey):
-      self.stats[pkey] = {rkey: 1}
-    elif not self.stats[pkey].get(rkey):
-      self.stats[pkey][rkey] = 1
-    else:
-      self.stats[pkey][rkey] += 1
+    with self.lock:
+      if not self.stats.get(pkey):
+        self.stats[pkey] = {rkey: count}
+      elif not self.stats[pkey].get(rkey):
+        self.stats[pkey][rkey] = count
+      else:
+        self.stats[pkey][rkey] += count
 
   def summarize(self, level):
     logger.log(level, 'Summary:')
@@ -0,0 +1,107 @@
+from reviewer import CallType
+from reviewer import Reviewer
+
+import contextlib
+import logging
+import pathlib
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger('rom.worktree')
+
+class WorktreePool(object):
+  '''
+  A pool of `git worktree`s of a local repo, for jobs which need to check out
+  and build other commits without touching the main checkout (or each other).
+  Worktrees are created on demand, up to size of them, and recycled between
+  jobs. They share the main repo's object store, so anything fetched there can
+  be checked out in any worktree.
+  '''
+  def __init__(self, git_dir, path, size=1):
+    self.path = pathlib.Path(path)
+    self.size = size
+    self.repo = Reviewer(git_dir=git_dir)
+    self.lock = threading.Lock()
+    self.available = threading.Condition(self.lock)
+    self.free = []
+    # Indices of the worktrees which exist (or are being created)
+    self.indices = set()
+
+    self.path.mkdir(parents=True, exist_ok=True)
+    # Forget about worktrees whose directories have gone away
+    self.repo.git(['worktree', 'prune'], CallType.CHECK_CALL)
+
+  def close(self):
+    with self.lock:
+      for wt in self.free:
+        wt.close()
+      self.free = []
+    self.repo.close()
+
+  def __create(self, index, commit):
+    wt_path = self.path.joinpath('worktree{}'.format(index))
+    wt = Reviewer(git_dir=str(wt_path))
+
+    # Worktrees left behind by a previous run are reused if they're still
+    # registered with the repo, otherwise they're recreated
+    if wt_path.joinpath('.git').exists():
+      try:
+        self.__reset(wt, commit)
+        return wt
+      except subprocess.CalledProcessError:
+        logger.warning('Recreating stale worktree {}'.format(wt_path))
+        shutil.rmtree(str(wt_path))
+        self.repo.git(['worktree', 'prune'], CallType.CHECK_CALL)
+
+    logger.debug('Creating worktree {}'.format(wt_path))
+    self.repo.git(['worktree', 'add', '--detach', '--force', str(wt_path),
+                   commit], CallType.CHECK_CALL)
+    return wt
+
+  def __reset(self, wt, commit):
+    wt.git(['checkout', '--quiet', '--force', '--detach', commit],
+           CallType.CHECK_CALL)
+    wt.git(['clean', '--quiet', '-fdx'], CallType.CHECK_CALL)
+
+  @contextlib.contextmanager
+  def acquire(self, commit, block=True):
+    # Yields a Reviewer for a clean worktree with commit checked out. The
+    # worktree goes back in the pool when the block exits. If block is False
+    # and all the worktrees are busy, None is yielded instead.
+    index = None
+    with self.available:
+      while not self.free and len(self.indices) >= self.size:
+        if not block:
+          break
+        self.available.wait()
+
+      if self.free:
+        wt = self.free.pop()
+      elif len(self.indices) < self.size:
+        index = min(set(range(self.size)) - self.indices)
+        self.indices.add(index)
+      else:
+        wt = None
+
+    if index is None and wt is None:
+      yield None
+      return
+
+    if index is not None:
+      try:
+        wt = self.__create(index, commit)
+      except:
+        with self.available:
+          self.indices.discard(index)
+          self.available.notify()
+        raise
+
+    try:
+      if index is None:
+        self.__reset(wt, commit)
+      yield wt
+    finally:
+      with self.available:
+        self.free.append(wt)
+        self.available.notify()